@@ -0,0 +1,90 @@
+'''
+Measures QueueMixin claim throughput against a running MongoDB.
+
+    python benchmarks/queue_throughput.py --uri mongodb://localhost \
+        --jobs 20000 --workers 16 --batch 1 10 50
+'''
+import time
+import argparse
+import threading
+
+import pymongo
+
+from mongorm.base import ModelBase
+from mongorm.datatypes import Dict
+from mongorm.queue import QueueMixin, Backoff
+
+DATABASE = None
+
+
+class BenchmarkJob(QueueMixin, ModelBase):
+    __tablename__ = "mongorm_benchmark_job"
+
+    payload = Dict()
+
+    @classmethod
+    def using(cls):
+        return DATABASE
+
+
+def fill(jobs):
+    BenchmarkJob.mongo_collection(DATABASE).drop()
+    BenchmarkJob.mongo_collection(DATABASE).ensure_index(
+        [('queue_state', 1), ('priority', -1)])
+
+    for start in xrange(0, jobs, 1000):
+        BenchmarkJob.insert([{'payload': {'n': i}, 'priority': i % 10}
+                             for i in xrange(start, min(start + 1000, jobs))])
+
+
+def work(batch, counter, lock):
+    backoff = Backoff(min_wait=0.01, max_wait=0.1)
+    for jobs in BenchmarkJob.poll(limit=batch, backoff=backoff,
+                                  idle_timeout=0.5):
+        BenchmarkJob.complete_many(jobs)
+        with lock:
+            counter[0] += len(jobs)
+
+
+def run(jobs, workers, batch):
+    fill(jobs)
+    counter = [0]
+    lock = threading.Lock()
+    threads = [threading.Thread(target=work, args=(batch, counter, lock))
+               for _ in xrange(workers)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Every worker waits out idle_timeout once the queue drains.
+    elapsed = time.time() - start - 0.5
+
+    return counter[0], elapsed
+
+
+def main():
+    global DATABASE
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uri', default='mongodb://localhost')
+    parser.add_argument('--database', default='mongorm_benchmark')
+    parser.add_argument('--jobs', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    DATABASE = pymongo.MongoClient(args.uri)[args.database]
+
+    print "%8s %10s %10s %12s" % ("batch", "jobs", "seconds", "jobs/sec")
+    for batch in args.batch:
+        done, elapsed = run(args.jobs, args.workers, batch)
+        print "%8d %10d %10.2f %12.1f" % (batch, done, elapsed,
+                                          done / max(elapsed, 1e-9))
+
+    BenchmarkJob.mongo_collection(DATABASE).drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+'''
+Regression benchmarks for the ModelBase hot paths.
+
+Runs against the in-process MemoryDatabase by default, or a real server
+with --uri. Results can be stored as a baseline and later runs compared
+against it; a drop in ops/sec beyond --tolerance is flagged and makes the
+run exit non-zero.
+
+The memory column is the peak traced bytes of one call where tracemalloc
+exists. On Python 2 it is the peak number of gc-tracked objects alive at
+once during a call, above the count at its start.
+
+    python benchmarks/suite.py --save benchmarks/baseline.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json
+    python benchmarks/suite.py --uri mongodb://localhost --explain
+'''
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from mongorm.base import ModelBase
+from mongorm.memory import MemoryDatabase
+from mongorm.datatypes import Unichar, Integer, Decimal, List, Dict
+
+FIELD_COUNTS = (5, 20, 80)
+VALUE_SIZES = (8, 256)
+DATABASE = [None]
+
+
+def build_model(field_count):
+    attrs = {
+        '__tablename__': 'mongorm_benchmark_%d' % field_count,
+        'using': classmethod(lambda cls: DATABASE[0])
+    }
+    kinds = (Unichar, Integer, Decimal, List, Dict)
+    for i in xrange(field_count):
+        attrs['f%d' % i] = kinds[i % len(kinds)]()
+
+    return type('Benchmark%d' % field_count, (ModelBase,), attrs)
+
+
+def build_document(model, value_size):
+    document = {}
+    for name, datatype in model.fields.iteritems():
+        if isinstance(datatype, Unichar) and name != '_id':
+            document[name] = u'x' * value_size
+        elif isinstance(datatype, Decimal):
+            document[name] = 1.5
+        elif isinstance(datatype, Integer):
+            document[name] = value_size
+        elif isinstance(datatype, List):
+            document[name] = range(value_size // 8)
+        elif isinstance(datatype, Dict):
+            document[name] = {'nested': u'x' * value_size}
+    return document
+
+
+def query_shape(query):
+    '''
+    Replaces literal values in a query with their type names so queries
+    differing only in values map to the same shape.
+    '''
+    if isinstance(query, dict):
+        return dict((k, query_shape(v)) for k, v in query.iteritems())
+    if isinstance(query, (list, tuple)):
+        return [query_shape(v) for v in query]
+    return type(query).__name__
+
+
+def cases(model, document):
+    '''
+    Yields (name, operation, query) tuples. `query` is the filter
+    the operation sends, if any, and is used for explain output.
+    '''
+    model.mongo_collection(DATABASE[0]).drop()
+    ids = model.insert([dict(document) for _ in xrange(200)])
+    saved = model.get_one({'_id': ids[0]})
+    instance = model(partial_model=True, **saved)
+    names = [n for n in model.fields if n != '_id']
+
+    def validate():
+        model.validate_type(dict(document, _id=model.generate_id()))
+
+    def validate_many():
+        model.validate_many([dict(document, _id=model.generate_id())
+                             for _ in xrange(100)])
+
+    def insert():
+        model.insert(dict(document))
+
+    def save():
+        instance.save()
+
+    def get():
+        for doc in model._get({'_id': {'$in': ids[:20]}}):
+            model(partial_model=True, **doc)
+
+    def access():
+        for name in names:
+            getattr(instance, name)
+
+    yield 'validate_type', validate, None
+    yield 'validate_many (100 documents)', validate_many, None
+    yield 'attribute_access', access, None
+    yield 'save', save, {'_id': instance._id}
+    yield '_get+construct', get, {'_id': {'$in': ids[:20]}}
+    # Last, as it grows the collection the other cases read from.
+    yield 'insert', insert, None
+
+
+def peak_objects(operation):
+    '''
+    Returns the peak number of gc-tracked objects alive during one call.
+
+    Python 2 has no allocation counter. The collector's generation 0
+    count goes up with each tracked allocation and down with each free,
+    so with collection disabled it is sampled on every traced line and
+    call to find the high-water mark.
+    '''
+    peak = [0]
+
+    def trace(frame, event, arg):
+        count = gc.get_count()[0]
+        if count > peak[0]:
+            peak[0] = count
+        return trace
+
+    gc.collect()
+    gc.disable()
+    sys.settrace(trace)
+    try:
+        operation()
+    finally:
+        sys.settrace(None)
+        gc.enable()
+    return peak[0]
+
+
+def measure(operation, min_time):
+    operation()
+    count = 0
+    start = time.time()
+    while True:
+        operation()
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+
+    if tracemalloc:
+        tracemalloc.start()
+        operation()
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        unit = 'peak bytes'
+    else:
+        allocated = peak_objects(operation)
+        unit = 'peak objects'
+
+    return count / elapsed, allocated, unit
+
+
+def explain(model, query):
+    cursor = model._get(query)
+    return cursor.explain()
+
+
+def run(min_time, with_explain):
+    results = {}
+    for field_count in FIELD_COUNTS:
+        model = build_model(field_count)
+        for value_size in VALUE_SIZES:
+            document = build_document(model, value_size)
+            for name, operation, query in cases(model, document):
+                key = '%s/fields=%d/value=%d' % (name, field_count,
+                                                 value_size)
+                ops, allocated, unit = measure(operation, min_time)
+                results[key] = {
+                    'ops_per_sec': ops,
+                    'allocated': allocated,
+                    'allocated_unit': unit
+                }
+                if with_explain and query is not None:
+                    results[key]['query_shape'] = query_shape(query)
+                    results[key]['explain'] = explain(model, query)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in sorted(results.iteritems()):
+        base = baseline.get(key)
+        if not base:
+            continue
+        ratio = result['ops_per_sec'] / base['ops_per_sec']
+        if ratio < 1 - tolerance:
+            regressions.append((key, ratio))
+    return regressions
+
+
+def report(results, baseline):
+    print "%-42s %14s %10s %10s" % ("case", "ops/sec", "vs base", "memory/op")
+    for key, result in sorted(results.iteritems()):
+        base = baseline.get(key)
+        change = "%+.1f%%" % (
+            (result['ops_per_sec'] / base['ops_per_sec'] - 1) * 100) \
+            if base else "-"
+        print "%-42s %14.1f %10s %10.1f %s" % (
+            key, result['ops_per_sec'], change, result['allocated'],
+            result['allocated_unit'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uri', default=None,
+                        help="Run against a server instead of memory")
+    parser.add_argument('--database', default='mongorm_benchmark')
+    parser.add_argument('--min-time', type=float, default=0.5)
+    parser.add_argument('--save', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--explain', action='store_true',
+                        help="Record query shape and explain output")
+    args = parser.parse_args()
+
+    if args.uri:
+        import pymongo
+        DATABASE[0] = pymongo.MongoClient(args.uri)[args.database]
+    else:
+        DATABASE[0] = MemoryDatabase(args.database)
+
+    results = run(args.min_time, args.explain)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'backend': 'server' if args.uri else 'memory',
+                'results': results
+            }, f, indent=2, sort_keys=True, default=str)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for key, ratio in regressions:
+        print "REGRESSION %s at %.0f%% of baseline" % (key, ratio * 100)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+from bson.son import SON
+
+from .errors import ORMException
+from .meta import DbDictClass
+from .records import TIMESTAMP_FIELDS
+
+
+def _query_fields(query):
+    fields = set()
+    for key, value in query.iteritems():
+        if key in ('$and', '$or', '$nor'):
+            for q in value:
+                fields.update(_query_fields(q))
+        elif not key.startswith('$'):
+            fields.add(key)
+    return fields
+
+
+def _references(expression):
+    if isinstance(expression, basestring):
+        if expression.startswith('$') and not expression.startswith('$$'):
+            return set([expression[1:].split('.')[0]])
+        return set()
+
+    refs = set()
+    if isinstance(expression, dict):
+        for value in expression.itervalues():
+            refs.update(_references(value))
+    elif isinstance(expression, (list, tuple)):
+        for value in expression:
+            refs.update(_references(value))
+    return refs
+
+
+def _is_flag(value):
+    return value in (0, 1) or isinstance(value, bool)
+
+
+def _prefixes(path):
+    parts = path.split('.')
+    return ['.'.join(parts[:i]) for i in xrange(1, len(parts) + 1)]
+
+
+def _passes_through(project, paths):
+    '''
+    True when every field path in `paths` leaves the $project stage
+    unchanged.
+    '''
+    flags = dict((k, v) for k, v in project.iteritems() if _is_flag(v))
+    computed = set(k.split('.')[0] for k, v in project.iteritems()
+                   if not _is_flag(v))
+    inclusive = computed or any(v for k, v in flags.iteritems()
+                                if k != '_id')
+
+    for path in paths:
+        prefixes = _prefixes(path)
+        if prefixes[0] in computed:
+            return False
+
+        if inclusive:
+            if not any(flags.get(p) for p in prefixes) and \
+               not (path == '_id' and flags.get('_id', True)):
+                return False
+        elif any(p in flags for p in prefixes) or \
+                any(k.startswith(path + '.') for k in flags):
+            return False
+    return True
+
+
+def _sort_fields(spec):
+    return set(spec)
+
+
+class Pipeline(object):
+    '''
+    Builds an aggregation pipeline for a model.
+
+    Field references are checked against the model's fields for as long as
+    documents keep the model's shape. $match and $project stages are
+    moved ahead of stages they commute with before the pipeline is run.
+
+        Invoice.pipeline().match({'paid': True}) \\
+            .group({'_id': '$tenant', 'total': {'$sum': '$amount'}}) \\
+            .cursor(batch_size=500, allow_disk_use=True)
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.stages = []
+        self.shape = set(model.fields) | set(['_id']) | \
+            set(TIMESTAMP_FIELDS)
+        self.typed = True
+
+    def _check(self, fields, stage):
+        if self.shape is None:
+            return
+
+        unknown = sorted(set(f.split('.')[0] for f in fields) - self.shape)
+        if unknown:
+            raise ORMException(
+                "Invalid field reference %s in %s stage on %s"
+                % (', '.join(unknown), stage, self.model.__tablename__))
+
+    def _add(self, stage, spec):
+        self.stages.append({stage: spec})
+        return self
+
+    def match(self, query):
+        if not isinstance(query, dict):
+            raise ORMException("$match accepts only a dict")
+
+        if self.typed:
+            self.model.check_fields(query)
+        self._check(_query_fields(query), '$match')
+        return self._add('$match', query)
+
+    def project(self, spec):
+        if not isinstance(spec, dict):
+            raise ORMException("$project accepts only a dict")
+
+        included = set(k.split('.')[0] for k, v in spec.iteritems()
+                       if _is_flag(v) and v)
+        excluded = set(k for k, v in spec.iteritems() if _is_flag(v) and
+                       not v)
+        computed = set(k for k, v in spec.iteritems() if not _is_flag(v))
+        self._check(included | _references(spec), '$project')
+
+        if included or computed:
+            self.shape = included | computed | (set(['_id']) - excluded)
+        elif self.shape is not None:
+            self.shape = self.shape - excluded
+
+        if computed:
+            self.typed = False
+        return self._add('$project', spec)
+
+    def group(self, spec):
+        if '_id' not in spec:
+            raise ORMException("$group requires an _id")
+
+        self._check(_references(spec), '$group')
+        self.shape = set(spec)
+        self.typed = False
+        return self._add('$group', spec)
+
+    def sort(self, spec):
+        if isinstance(spec, (list, tuple)):
+            # SON keeps the key order on the wire.
+            spec = SON(spec)
+
+        self._check(_sort_fields(spec), '$sort')
+        return self._add('$sort', spec)
+
+    def unwind(self, path):
+        self._check(_references(path), '$unwind')
+        self.typed = False
+        return self._add('$unwind', path)
+
+    def limit(self, count):
+        return self._add('$limit', int(count))
+
+    def skip(self, count):
+        return self._add('$skip', int(count))
+
+    def stage(self, stage):
+        '''
+        Appends a raw stage. Field references are no longer validated
+        after it as the document shape is unknown.
+        '''
+        self.shape = None
+        self.typed = False
+        self.stages.append(stage)
+        return self
+
+    @staticmethod
+    def _can_swap(prev, cur):
+        (prev_op, prev_spec), = prev.items()
+        (cur_op, cur_spec), = cur.items()
+
+        if cur_op == '$match':
+            fields = _query_fields(cur_spec)
+            if any(k in cur_spec for k in ('$where', '$text')):
+                return False
+            if prev_op == '$sort':
+                return True
+            if prev_op == '$project':
+                return _passes_through(prev_spec, fields)
+
+        elif cur_op == '$project' and prev_op == '$sort':
+            return _passes_through(cur_spec, _sort_fields(prev_spec))
+
+        return False
+
+    def optimized(self):
+        '''
+        Returns the stages with $match/$project moved ahead of the stages
+        they commute with and adjacent $match stages merged.
+        '''
+        stages = []
+        for stage in self.stages:
+            stages.append(stage)
+            i = len(stages) - 1
+            while i and self._can_swap(stages[i - 1], stages[i]):
+                stages[i - 1], stages[i] = stages[i], stages[i - 1]
+                i -= 1
+
+        merged = []
+        for stage in stages:
+            if merged and '$match' in stage and '$match' in merged[-1]:
+                merged[-1] = {'$match': {
+                    '$and': [merged[-1]['$match'], stage['$match']]}}
+            else:
+                merged.append(stage)
+        return merged
+
+    def cursor(self, batch_size=None, allow_disk_use=False,
+               max_time_ms=None, timeout=None):
+        '''
+        Runs the pipeline and streams results. Documents which still have
+        the model's shape are yielded as model instances, others as
+        DbDictClass. Streaming stops with QueryTimeout once the deadline
+        or `timeout` seconds have run out.
+        '''
+        kwargs = {'cursor': {}, 'timeout': timeout}
+        if batch_size:
+            kwargs['cursor']['batchSize'] = batch_size
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        if max_time_ms:
+            kwargs['maxTimeMS'] = max_time_ms
+
+        results = self.model.aggregate(self.optimized(), **kwargs)
+        if self.typed:
+            return (self.model(partial_model=True, **doc) for doc in results)
+        return (DbDictClass(doc) for doc in results)
+
+    def __iter__(self):
+        return self.cursor()
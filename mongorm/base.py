@@ -1,12 +1,29 @@
 import re
 import pymongo
 import datetime
+from itertools import imap, izip
+from operator import itemgetter
 
+from . import deadline
 from .errors import ORMException
 from .meta import ModelMeta, DbDictClass, ModelDefinition
+from .aggregation import Pipeline
+from .records import record_class
 from .datatypes import ObjectId, ID, Boolean, DataType, List, Dict
 
 
+DATABASE_TYPES = [pymongo.database.Database]
+
+
+def register_database_type(database_type):
+    '''
+    Allows `using` to return instances of database_type, e.g. an
+    in-process stand-in for pymongo.database.Database.
+    '''
+    if database_type not in DATABASE_TYPES:
+        DATABASE_TYPES.append(database_type)
+
+
 class ModelBase(ModelDefinition):
     __baseclass__ = True
     __metaclass__ = ModelMeta
@@ -23,7 +40,7 @@ class ModelBase(ModelDefinition):
                 Error in model %s. Using is a required attribute.
                 ''' % cls.__name__)
 
-        if not isinstance(using, pymongo.database.Database):
+        if not isinstance(using, tuple(DATABASE_TYPES)):
             raise ORMException(
                 '''
                 Error in model %s.
@@ -36,6 +53,13 @@ class ModelBase(ModelDefinition):
     def using(cls):
         raise NotImplementedError
 
+    @classmethod
+    def database_for(cls, document):
+        '''
+        Returns the database a stored document lives in.
+        '''
+        return cls.valid_database()
+
     def validate(cls):
         pass
 
@@ -79,46 +103,68 @@ class ModelBase(ModelDefinition):
     def mongo_collection(cls, database):
         return getattr(database, cls.__tablename__)
 
+    @classmethod
+    def fill_required(cls, data_dict):
+        '''
+        Sets missing required fields to their defaults. Returns errors
+        for the ones without a default.
+        '''
+        errors = []
+        for field in cls.required_fields:
+            if field not in data_dict:
+                if field in cls.defaults:
+                    data_dict[field] = cls.defaults[field]
+                else:
+                    errors.append("%s is a required field" % field)
+        return errors
+
+    @classmethod
+    def key_type(cls, key):
+        '''
+        Returns the DataType checking `key`, or None, and an error for
+        dotted keys into fields which are neither a dict nor a list.
+        '''
+        key_split = key.split('.')
+        typeobj = cls.fields.get(key_split[0], None)
+
+        if not typeobj or not isinstance(typeobj, DataType):
+            return None, None
+
+        if len(key_split) > 1:
+            # dots can be used for settings value in array.
+            # using index as key. i.e. {'$set': {myarray.0: 'val'}}
+            # should be allowed
+            if typeobj.datatype == dict or typeobj.datatype == list:
+                return None, None
+            return typeobj, "%s should be of type %s. " % (
+                key, typeobj.datatype)
+
+        return typeobj, None
+
     @classmethod
     def validate_type(cls, data_dict, check_required=True):
         model_keys = []
         errors = []
 
         if check_required:
-            for field in cls.required_fields:
-                if field not in data_dict:
-                    if field in cls.defaults:
-                        data_dict[field] = cls.defaults[field]
-                    else:
-                        errors.append("%s is a required field" % field)
+            errors.extend(cls.fill_required(data_dict))
 
         if not errors:
             for key, value in data_dict.iteritems():
-                key_split = key.split('.')
-                check_key = key_split[0]
-                model_keys.append(check_key)
-                typeobj = cls.fields.get(check_key, None)
+                model_keys.append(key.split('.')[0])
+                typeobj, error = cls.key_type(key)
 
-                if not typeobj or not isinstance(typeobj, DataType):
+                if typeobj is None:
                     continue
 
-                if len(key_split) > 1:
-                    # dots can be used for settings value in array.
-                    # using index as key. i.e. {'$set': {myarray.0: 'val'}}
-                    # should be allowed
-                    if typeobj.datatype == dict or typeobj.datatype == list:
-                        continue
-                    errors.append("%s should be of type %s. "
-                                  % (key, typeobj.datatype))
+                if error:
+                    errors.append(error)
 
                 try:
                     data_dict[key] = typeobj.dbfy(value)
                 except Exception, e:
-                    error = getattr(e, "log_message", None) or \
-                        getattr(e, "error_message", None) or \
-                        "Expected %s. Found %s" % (typeobj.datatype, value)
-
-                    errors.append("Field: %s, Error: %s" % (key, error))
+                    errors.append("Field: %s, Error: %s"
+                                  % (key, cls.type_error(typeobj, value, e)))
 
         if errors:
             raise ORMException(errors)
@@ -126,11 +172,75 @@ class ModelBase(ModelDefinition):
         return model_keys
 
     @classmethod
-    def insert(cls, document):
+    def type_error(cls, typeobj, value, e):
+        return getattr(e, "log_message", None) or \
+            getattr(e, "error_message", None) or \
+            "Expected %s. Found %s" % (typeobj.datatype, value)
+
+    @classmethod
+    def validate_many(cls, documents, check_required=True):
+        '''
+        Validates a list of documents in place, column by column.
+
+        Documents are grouped by their set of keys and each key is
+        converted with one DataType.dbfy_column call per group, so
+        fields are looked up once per column instead of once per value.
+        Errors name the position of the failing document.
+        '''
+        errors = []
+        groups = {}
+
+        for index, data_dict in enumerate(documents):
+            missing = cls.fill_required(data_dict) if check_required else []
+            if missing:
+                errors.extend((index, error) for error in missing)
+            else:
+                groups.setdefault(frozenset(data_dict), []).append(index)
+
+        for keys, indexes in groups.iteritems():
+            for key in keys:
+                typeobj, error = cls.key_type(key)
+
+                if typeobj is None:
+                    continue
+
+                if error:
+                    errors.extend((i, error) for i in indexes)
+
+                values = [documents[i][key] for i in indexes]
+                converted, failed = typeobj.dbfy_column(values)
+                for i, value in izip(indexes, converted):
+                    documents[i][key] = value
+
+                for position, e in failed:
+                    error = cls.type_error(typeobj, values[position], e)
+                    errors.append((indexes[position],
+                                   "Field: %s, Error: %s" % (key, error)))
+
+        if errors:
+            errors.sort(key=itemgetter(0))
+            raise ORMException(["Document %d, %s" % (number, message)
+                                for number, message in errors])
+
+    @classmethod
+    def insert(cls, document, timeout=None):
         if not document:
             return [None, []][document == []]
 
         documents = document if isinstance(document, list) else [document]
+        validated_docs = cls.validate_insert(documents)
+
+        if not validated_docs:
+            return [None, []][validated_docs == []]
+
+        return cls.insert_validated(validated_docs, timeout=timeout)
+
+    @classmethod
+    def validate_insert(cls, documents):
+        '''
+        Stamps ids and timestamps on `documents` and returns validated
+        copies with the model defaults filled in.
+        '''
         validated_docs = []
 
         for d in documents:
@@ -139,36 +249,66 @@ class ModelBase(ModelDefinition):
             d['modified_on'] = cls.now()
 
             cls.prepare_insert_document(d)
+            validated_docs.append(dict(cls.defaults, **d))
 
-            document = dict(cls.defaults, **d)
-            cls.validate_type(document)
-            validated_docs.append(document)
+        if len(validated_docs) > 1:
+            cls.validate_many(validated_docs)
+        elif validated_docs:
+            cls.validate_type(validated_docs[0])
 
-        if not validated_docs:
-            return [None, []][validated_docs == []]
+        return validated_docs
 
+    @classmethod
+    def insert_validated(cls, validated_docs, timeout=None):
+        expires = deadline.expiry(timeout)
         database = cls.valid_database()
         call = cls.mongo_collection(database)
-        ids = call.insert(validated_docs)
+        deadline.remaining(expires)
+        with deadline.guard(expires):
+            ids = call.insert(validated_docs)
+
+        if cls.__views__:
+            cls.update_views(database, [], validated_docs)
 
         cls.on_insert(ids)
         return ids
 
     @classmethod
-    def aggregate(cls, commands):
+    def aggregate(cls, commands, **kwargs):
         if not isinstance(commands, list):
             raise ORMException(
                 "Aggregate accepts only a List of commands as arguments")
 
+        expires = deadline.expiry(kwargs.pop('timeout', None))
+        left = deadline.remaining(expires)
+        if left is not None and 'maxTimeMS' not in kwargs:
+            kwargs['maxTimeMS'] = deadline.to_ms(left)
+
         database = cls.valid_database()
         call = cls.mongo_collection(database)
-        return call.aggregate(commands)
+        with deadline.guard(expires):
+            result = call.aggregate(commands, **kwargs)
+
+        if left is None or isinstance(result, dict):
+            return result
+        # Streamed results keep fetching batches after this call.
+        return deadline.DeadlineCursor(result, expires)
+
+    @classmethod
+    def pipeline(cls):
+        return Pipeline(cls)
 
     @classmethod
     def group(cls, *args, **kwargs):
+        expires = deadline.expiry(kwargs.pop('timeout', None))
+        left = deadline.remaining(expires)
+        if left is not None and 'maxTimeMS' not in kwargs:
+            kwargs['maxTimeMS'] = deadline.to_ms(left)
+
         database = cls.valid_database()
         call = cls.mongo_collection(database)
-        return call.group(*args, **kwargs)
+        with deadline.guard(expires):
+            return call.group(*args, **kwargs)
 
     def prepare_save_document(cls):
         pass
@@ -197,14 +337,35 @@ class ModelBase(ModelDefinition):
     def on_insert(cls, ids):
         pass
 
+    @classmethod
+    def view_fields(cls):
+        fields = set(['_id', 'deleted'])
+        for view in cls.__views__.itervalues():
+            fields.update(view.fields)
+        return list(fields)
+
+    @classmethod
+    def touched_views(cls, document):
+        fields = set()
+        for value in document.itervalues():
+            if isinstance(value, dict):
+                fields.update(k.split('.')[0] for k in value)
+        return [v for v in cls.__views__.itervalues() if v.touches(fields)]
+
+    @classmethod
+    def update_views(cls, database, before, after, views=None):
+        for view in (cls.__views__.values() if views is None else views):
+            view.apply(cls, database, before, after)
+
     @classmethod
     def on_update(cls, filter_args, document, updated_fields=None):
         pass
 
-    def save(self, validate=True):
+    def save(self, validate=True, timeout=None):
         if callable(self.pre_save):
             self.pre_save()
 
+        expires = deadline.expiry(timeout)
         database = self.valid_database()
 
         self.modified_on = self.now()
@@ -224,6 +385,11 @@ class ModelBase(ModelDefinition):
 
         call = self.mongo_collection(database)
 
+        before = []
+        if self.__views__ and existing_id:
+            before = list(deadline.find(call, expires, {'_id': existing_id},
+                                        fields=self.view_fields(), limit=1))
+
         if existing_id:
             document = {'$set': self}
             filter_args = {"_id": existing_id}
@@ -236,8 +402,10 @@ class ModelBase(ModelDefinition):
             self.prepare_insert_document(self)
             self.on_insert(self._id)
 
+        deadline.remaining(expires)
         try:
-            call.save(self)
+            with deadline.guard(expires):
+                call.save(self)
         except pymongo.errors.DuplicateKeyError, e:
             pattern = re.compile(
                 r'.+\s+(?P<db_name>\w+)\.(?P<table_name>\w+)\.\$(?P<field_name>\w+)_\d+.*\"(?P<value>.*)\".*}.*')
@@ -250,6 +418,9 @@ class ModelBase(ModelDefinition):
 
             raise ORMException('%s' % e.args[0])
 
+        if self.__views__:
+            self.update_views(database, before, [self])
+
         if callable(self.post_save):
             self.post_save()
 
@@ -328,10 +499,8 @@ class ModelBase(ModelDefinition):
         return call, filter_args, document, kwargs
 
     @classmethod
-    def find_and_modify(cls, *args, **kwargs):
+    def sort_spec(cls, sort=None, sortkey=None):
         _sort = {}
-        sort = kwargs.pop('sort', None)
-        sortkey = kwargs.pop('sortkey', None)
 
         if sort is None and sortkey is None:
             pass
@@ -348,8 +517,47 @@ class ModelBase(ModelDefinition):
                 Alternatively use sortkey=field & sort=direction
                 ''')
 
+        return _sort
+
+    @classmethod
+    def find_and_modify(cls, *args, **kwargs):
+        _sort = cls.sort_spec(kwargs.pop('sort', None),
+                              kwargs.pop('sortkey', None))
+        expires = deadline.expiry(kwargs.pop('timeout', None))
+
         call, _f, _d, _k = cls.__update(*args, **kwargs)
-        return call.find_and_modify(query=_f, update=_d, sort=_sort, **_k)
+
+        views = cls.touched_views(_d)
+        fields = cls.view_fields()
+        before = []
+        if views:
+            before = list(deadline.find(call, expires, _f, fields=fields,
+                                        sort=_sort.items() or None, limit=1))
+        if before:
+            # Pin the write to the document read, so the fold matches it.
+            _f = dict(_f, _id=before[0]['_id'])
+
+        left = deadline.remaining(expires)
+        if left is not None:
+            _k.setdefault('maxTimeMS', deadline.to_ms(left))
+
+        with deadline.guard(expires):
+            result = call.find_and_modify(query=_f, update=_d, sort=_sort,
+                                          **_k)
+        if not views:
+            return result
+
+        if before:
+            after = list(deadline.find(call, expires,
+                                       {'_id': before[0]['_id']},
+                                       fields=fields))
+        else:
+            # Nothing matched; an upserted document matches the query.
+            after = list(deadline.find(call, expires, _f, fields=fields,
+                                       limit=1))
+
+        cls.update_views(call.database, before, after, views)
+        return result
 
     @classmethod
     def update(cls, *args, **kwargs):
@@ -386,15 +594,34 @@ class ModelBase(ModelDefinition):
                 {u'_id': ObjectId('52134596785c1e073a04692b')})
                 ''')
 
+        expires = deadline.expiry(kwargs.pop('timeout', None))
         call, _f, _d, _k = cls.__update(*args, **kwargs)
         _k['safe'] = [True, kwargs.get('safe')]['safe' in kwargs]
         _k['multi'] = [True, kwargs.get('multi')]['multi' in kwargs]
 
-        return call.update(_f, document=_d, **_k)
+        views = cls.touched_views(_d)
+        if not views:
+            deadline.remaining(expires)
+            with deadline.guard(expires):
+                return call.update(_f, document=_d, **_k)
+
+        fields = cls.view_fields()
+        before = list(deadline.find(call, expires, _f, fields=fields,
+                                    limit=0 if _k['multi'] else 1))
+        deadline.remaining(expires)
+        with deadline.guard(expires):
+            result = call.update(_f, document=_d, **_k)
+        after = list(deadline.find(
+            call, expires, {'_id': {'$in': [d['_id'] for d in before]}},
+            fields=fields))
+
+        cls.update_views(call.database, before, after, views)
+        return result
 
     @classmethod
     def _get(cls, filter_args=None, limit=None, skip=0, sort=-1,
-             sortkey='_id', max_scan=None, fields=None, **kwargs):
+             sortkey='_id', max_scan=None, fields=None, as_class=DbDictClass,
+             timeout=None, **kwargs):
 
         if isinstance(filter_args, basestring) and \
            len(filter_args) == 24 and \
@@ -426,11 +653,12 @@ class ModelBase(ModelDefinition):
         cls.prepare_get_query(filter_args)
 
         coll = cls.mongo_collection(cls.valid_database())
-        return coll.find(filter_args, sort=sort, fields=fields,
-                         limit=limit or 0,
-                         skip=skip or 0, max_scan=max_scan,
-                         as_class=DbDictClass,
-                         manipulate=False)
+        return deadline.find(coll, deadline.expiry(timeout), filter_args,
+                             sort=sort, fields=fields,
+                             limit=limit or 0,
+                             skip=skip or 0, max_scan=max_scan,
+                             as_class=as_class,
+                             manipulate=False)
 
     @classmethod
     def count(cls, *args, **kwargs):
@@ -448,6 +676,18 @@ class ModelBase(ModelDefinition):
     def get_many(cls, *args, **kwargs):
         return cls._get(*args, **kwargs)
 
+    @classmethod
+    def get_records(cls, *args, **kwargs):
+        fields = kwargs.get('fields')
+        if not isinstance(fields, (list, tuple)) or not fields:
+            raise ORMException(
+                "get_records requires fields as a list of field names")
+
+        record = record_class(cls, fields)
+        kwargs['fields'] = list(fields)
+        kwargs['as_class'] = dict
+        return imap(record._make, cls._get(*args, **kwargs))
+
     @classmethod
     def check_fields(cls, filter_args):
         for field in filter_args.iterkeys():
@@ -465,6 +705,7 @@ class ModelBase(ModelDefinition):
 
     @classmethod
     def remove(cls, _id, *args, **kwargs):
+        expires = deadline.expiry(kwargs.pop('timeout', None))
         database = cls.valid_database()
         call = cls.mongo_collection(database)
 
@@ -479,7 +720,8 @@ class ModelBase(ModelDefinition):
 
         on_delete = getattr(cls, "on_delete", None)
         if callable(on_delete):
-            documents = [x for x in call.find(filter_args)]
+            documents = [x for x in deadline.find(call, expires,
+                                                  filter_args)]
             cls.on_delete(documents)
 
         delete_doc = {
@@ -488,7 +730,18 @@ class ModelBase(ModelDefinition):
         }
 
         cls.prepare_delete_document(delete_doc)
-        call.update(filter_args, {'$set': delete_doc}, multi=True)
+
+        before = []
+        if cls.__views__:
+            before = list(deadline.find(call, expires, filter_args,
+                                        fields=cls.view_fields()))
+
+        deadline.remaining(expires)
+        with deadline.guard(expires):
+            call.update(filter_args, {'$set': delete_doc}, multi=True)
+
+        if cls.__views__:
+            cls.update_views(database, before, [])
 
     def delete(cls, *args, **kwargs):
         return cls.remove(cls._id)
@@ -4,6 +4,13 @@ from bson.objectid import ObjectId
 from .meta import DataTypeDefinition
 from .errors import DataTypeMismatch
 
+
+def _defined_in(cls, name):
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            return klass
+
+
 def check_defaults(func):
     def inner(self, value):
         if value is None:
@@ -42,6 +49,41 @@ class DataType(DataTypeDefinition):
             return value
         return self.datatype(value)
 
+    def column_filter(self):
+        '''
+        Returns a predicate for the values dbfy returns unchanged.
+        '''
+        datatype = self.datatype
+        return lambda value: type(value) is datatype
+
+    def dbfy_column(self, values):
+        '''
+        Converts a column of values from several documents.
+        Returns the converted values and a list of (position, exception)
+        for the values that failed.
+
+        Values passing column_filter skip the dbfy call; the rest go
+        through dbfy one by one. The filter is only trusted while dbfy
+        comes from the class defining it, so subclasses overriding dbfy
+        get the plain loop unless they override column_filter as well.
+        '''
+        keep = None
+        if _defined_in(type(self), 'dbfy') is \
+           _defined_in(type(self), 'column_filter'):
+            keep = self.column_filter()
+
+        dbfy = self.dbfy
+        result = list(values)
+        errors = []
+        for index, value in enumerate(result):
+            if keep and keep(value):
+                continue
+            try:
+                result[index] = dbfy(value)
+            except Exception, e:
+                errors.append((index, e))
+        return result, errors
+
 
 class Unichar(DataType):
     datatype = unicode
@@ -55,6 +97,9 @@ class Unichar(DataType):
 
         return super(Unichar, cls).dbfy(value)
 
+    def column_filter(cls):
+        return lambda value: type(value) is unicode
+
 
 class Regex(Unichar):
 
@@ -80,6 +125,15 @@ class Regex(Unichar):
             return value
         raise DataTypeMismatch("Invalid value %s" % value)
 
+    def column_filter(cls):
+        # Matching strings are returned as is, run only the compiled
+        # pattern over them.
+        search = cls.regex.search
+
+        def keep(value):
+            return value and isinstance(value, basestring) and search(value)
+        return keep
+
 id_re = re.compile('^\d{19}\w{5}$')
 url_re = re.compile(
     r'^file:///|https?://'  # http:// or https://
@@ -93,6 +147,9 @@ url_re = re.compile(
 email_re = re.compile(r'\w+(\.\w+)*@[-+\w]+(\.\w+)+')
 epoch_re = re.compile(r'^\d{13}$')
 
+INT64_MIN = -2 ** 64 / 2
+INT64_MAX = 2 ** 64 / 2 - 1
+
 
 class ID(Regex):
 
@@ -151,10 +208,14 @@ class Integer(DataType):
         if cls.datatype != type(value):
             value = cls.datatype(value)
 
-        if value and ((value > 2 ** 64 / 2 - 1) or (value < -2 ** 64 / 2)):
+        if value and ((value > INT64_MAX) or (value < INT64_MIN)):
             raise DataTypeMismatch('Only 8-byte integer are supported')
         return value
 
+    def column_filter(cls):
+        # A plain int never exceeds 8 bytes; longs go through dbfy.
+        return lambda value: type(value) is int
+
 
 class Decimal(DataType):
     datatype = float
@@ -168,6 +229,15 @@ class Decimal(DataType):
     def dbfy(cls, value):
         return float(value)
 
+    def dbfy_column(cls, values):
+        if type(cls).dbfy.__func__ is Decimal.dbfy.__func__:
+            try:
+                return map(float, values), []
+            except (TypeError, ValueError):
+                # None takes the default, the rest report their errors.
+                pass
+        return DataType.dbfy_column(cls, values)
+
 
 class Currency(Decimal):
     datatype = float
@@ -0,0 +1,170 @@
+'''
+Time budgets for ModelBase operations.
+
+A budget is set per context with deadline() or per call with the timeout
+argument that every ModelBase operation accepts; the earlier of the two
+wins. Reads get the remaining budget as maxTimeMS and as the client
+socket timeout, aggregates and groups as maxTimeMS, and cursors stop
+yielding once it is spent. Writes are only checked before they are sent,
+a write in flight is not bounded. Running out raises QueryTimeout.
+
+    with deadline(0.25):
+        user = User.get_one({'email': email})
+        orders = list(Order.get_many({'user': user._id}, timeout=0.1))
+'''
+import time
+import threading
+from contextlib import contextmanager
+
+import pymongo
+
+from .errors import QueryTimeout
+
+_state = threading.local()
+
+_SERVER_TIMEOUTS = tuple(
+    getattr(pymongo.errors, name) for name in ('ExecutionTimeout',)
+    if hasattr(pymongo.errors, name))
+
+_NETWORK_ERRORS = tuple(
+    getattr(pymongo.errors, name) for name in ('NetworkTimeout',
+                                               'AutoReconnect')
+    if hasattr(pymongo.errors, name))
+
+
+def current():
+    '''
+    Returns the absolute expiry of the innermost deadline context.
+    '''
+    return getattr(_state, 'expiry', None)
+
+
+@contextmanager
+def until(expiry):
+    '''
+    Enters a deadline context expiring at the absolute time `expiry`.
+    Used to carry a caller's deadline into worker threads.
+    '''
+    previous = current()
+    if expiry is not None and previous is not None:
+        expiry = min(expiry, previous)
+    _state.expiry = expiry if expiry is not None else previous
+    try:
+        yield _state.expiry
+    finally:
+        _state.expiry = previous
+
+
+def deadline(seconds):
+    return until(time.time() + seconds)
+
+
+def expiry(timeout=None):
+    '''
+    Combines the context deadline with a per call timeout in seconds.
+    '''
+    expires = current()
+    if timeout is not None:
+        call = time.time() + timeout
+        expires = call if expires is None else min(expires, call)
+    return expires
+
+
+def remaining(expires):
+    '''
+    Returns the seconds left before `expires`, or None without a deadline.
+    Raises QueryTimeout once it has passed.
+    '''
+    if expires is None:
+        return None
+
+    left = expires - time.time()
+    if left <= 0:
+        raise QueryTimeout("Query time budget exhausted")
+    return left
+
+
+def to_ms(seconds):
+    return max(1, int(seconds * 1000))
+
+
+def find(collection, expires, *args, **kwargs):
+    '''
+    Runs collection.find within the time left before `expires`.
+    '''
+    left = remaining(expires)
+    if left is None:
+        return collection.find(*args, **kwargs)
+
+    kwargs['network_timeout'] = left
+    cursor = collection.find(*args, **kwargs)
+    cursor.max_time_ms(to_ms(left))
+    return DeadlineCursor(cursor, expires)
+
+
+@contextmanager
+def guard(expires):
+    '''
+    Translates driver timeouts into QueryTimeout.
+    '''
+    try:
+        yield
+    except _SERVER_TIMEOUTS, e:
+        raise QueryTimeout("Operation exceeded time limit: %s" % e)
+    except _NETWORK_ERRORS, e:
+        if expires is not None and time.time() >= expires:
+            raise QueryTimeout("Operation exceeded time limit: %s" % e)
+        raise
+
+
+class DeadlineCursor(object):
+    '''
+    Wraps a cursor and stops iteration once the budget is spent. Cursors
+    returned by chained calls and slices, e.g. sort, limit or clone, are
+    wrapped as well.
+    '''
+
+    def __init__(self, cursor, expires):
+        self.cursor = cursor
+        self.expires = expires
+
+    def __iter__(self):
+        iterator = iter(self.cursor)
+        while True:
+            remaining(self.expires)
+            with guard(self.expires):
+                try:
+                    document = next(iterator)
+                except StopIteration:
+                    return
+            yield document
+
+    def next(self):
+        remaining(self.expires)
+        with guard(self.expires):
+            return self.cursor.next()
+
+    def _wrap(self, result):
+        if isinstance(result, type(self.cursor)):
+            return DeadlineCursor(result, self.expires)
+        return result
+
+    def __getitem__(self, index):
+        remaining(self.expires)
+        with guard(self.expires):
+            return self._wrap(self.cursor[index])
+
+    def count(self, *args, **kwargs):
+        remaining(self.expires)
+        with guard(self.expires):
+            return self.cursor.count(*args, **kwargs)
+
+    def __getattr__(self, key):
+        value = getattr(self.cursor, key)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with guard(self.expires):
+                return self._wrap(value(*args, **kwargs))
+        return call
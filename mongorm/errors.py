@@ -6,3 +6,6 @@ class DataTypeMismatch(Exception):
 
 class ORMException(Exception):
     pass
+
+class QueryTimeout(ORMException):
+    pass
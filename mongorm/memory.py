@@ -0,0 +1,608 @@
+'''
+In-process stand-in for pymongo databases and collections.
+
+Implements the subset of the pymongo 2.x API used by ModelBase so models
+can be exercised without a server, e.g. in tests and benchmarks:
+
+    class Sample(ModelBase):
+        __tablename__ = "sample"
+
+        @classmethod
+        def using(cls):
+            return DATABASE
+
+    DATABASE = MemoryDatabase()
+'''
+import re
+import copy
+import threading
+from collections import OrderedDict
+
+import pymongo
+from bson.objectid import ObjectId
+
+from .errors import ORMException
+from .base import register_database_type
+
+_MISSING = object()
+
+
+def _resolve(doc, path):
+    '''
+    Returns the values found at a dotted path. Arrays along the path are
+    traversed element-wise like the server does.
+    '''
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(v[part] for v in value
+                                 if isinstance(v, dict) and part in v)
+        values = found
+    return values
+
+
+def _candidates(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for v in value:
+                yield v
+
+
+def _compare(op, value, arg):
+    if op == '$eq':
+        return value == arg
+    if op == '$ne':
+        return value != arg
+    if op == '$in':
+        return value in arg
+    if op == '$nin':
+        return value not in arg
+    if value is None:
+        return False
+    if op == '$gt':
+        return value > arg
+    if op == '$gte':
+        return value >= arg
+    if op == '$lt':
+        return value < arg
+    if op == '$lte':
+        return value <= arg
+    if op == '$regex':
+        return isinstance(value, basestring) and \
+            re.search(arg, value) is not None
+    raise ORMException("Operator %s is not supported in memory" % op)
+
+
+def _match_condition(values, condition):
+    is_ops = isinstance(condition, dict) and condition and \
+        all(k.startswith('$') for k in condition)
+
+    if not is_ops:
+        if hasattr(condition, 'search') and hasattr(condition, 'pattern'):
+            return any(isinstance(v, basestring) and condition.search(v)
+                       for v in _candidates(values))
+        return any(v == condition for v in _candidates(values))
+
+    for op, arg in condition.iteritems():
+        if op == '$exists':
+            if bool(values) != bool(arg):
+                return False
+        elif op == '$size':
+            if not any(isinstance(v, list) and len(v) == arg
+                       for v in values):
+                return False
+        elif op == '$all':
+            if not all(any(a == v for v in _candidates(values))
+                       for a in arg):
+                return False
+        elif op == '$not':
+            if _match_condition(values, arg):
+                return False
+        elif op == '$elemMatch':
+            if not any(isinstance(v, dict) and matches(v, arg)
+                       for v in _candidates(values)):
+                return False
+        elif op in ('$ne', '$nin'):
+            positive = '$eq' if op == '$ne' else '$in'
+            if any(_compare(positive, v, arg) for v in _candidates(values)):
+                return False
+            if op == '$nin' and not values and None in arg:
+                return False
+            if op == '$ne' and not values and arg is None:
+                return False
+        elif op == '$options':
+            continue
+        else:
+            if op == '$in' and not values and None in arg:
+                continue
+            if op == '$eq' and not values and arg is None:
+                continue
+            if not any(_compare(op, v, arg) for v in _candidates(values)):
+                return False
+    return True
+
+
+def matches(doc, spec):
+    for key, condition in (spec or {}).iteritems():
+        if key == '$and':
+            if not all(matches(doc, s) for s in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, s) for s in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, s) for s in condition):
+                return False
+        else:
+            values = _resolve(doc, key)
+            if not values and condition is None:
+                continue
+            if not _match_condition(values, condition):
+                return False
+    return True
+
+
+def _parent(doc, path, create=True):
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+            continue
+        if part not in target:
+            if not create:
+                return None, parts[-1]
+            target[part] = {}
+        target = target[part]
+    return target, parts[-1]
+
+
+def _get_path(doc, path, default=None):
+    target, key = _parent(doc, path, create=False)
+    if target is None:
+        return default
+    if isinstance(target, list):
+        index = int(key)
+        return target[index] if index < len(target) else default
+    return target.get(key, default)
+
+
+def _set_path(doc, path, value):
+    target, key = _parent(doc, path)
+    if isinstance(target, list):
+        target[int(key)] = value
+    else:
+        target[key] = value
+
+
+def _unset_path(doc, path):
+    target, key = _parent(doc, path, create=False)
+    if isinstance(target, list):
+        target[int(key)] = None
+    elif target is not None:
+        target.pop(key, None)
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return value['$each']
+    return [value]
+
+
+def apply_update(doc, document):
+    if not any(k.startswith('$') for k in document):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(document))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+
+    for op, spec in document.iteritems():
+        for path, value in spec.iteritems():
+            value = copy.deepcopy(value)
+            current = _get_path(doc, path, _MISSING)
+
+            if op == '$set':
+                _set_path(doc, path, value)
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                base = 0 if current is _MISSING else current
+                _set_path(doc, path, base + value)
+            elif op == '$min':
+                if current is _MISSING or value < current:
+                    _set_path(doc, path, value)
+            elif op == '$max':
+                if current is _MISSING or value > current:
+                    _set_path(doc, path, value)
+            elif op in ('$push', '$pushAll', '$addToSet'):
+                items = value if op == '$pushAll' else _each(value)
+                target = [] if current is _MISSING else current
+                for item in items:
+                    if op != '$addToSet' or item not in target:
+                        target.append(item)
+                _set_path(doc, path, target)
+            elif op in ('$pull', '$pullAll'):
+                if current is _MISSING:
+                    continue
+                drop = value if op == '$pullAll' else [value]
+                if op == '$pull' and isinstance(value, dict):
+                    kept = [i for i in current if not (
+                        isinstance(i, dict) and matches(i, value))]
+                else:
+                    kept = [i for i in current if i not in drop]
+                _set_path(doc, path, kept)
+            else:
+                raise ORMException(
+                    "Update operator %s is not supported in memory" % op)
+
+
+def project(doc, fields):
+    if not fields:
+        return doc
+
+    if isinstance(fields, (list, tuple)):
+        fields = dict((f, 1) for f in fields)
+
+    include = [f for f, v in fields.iteritems() if v and f != '_id']
+    if include:
+        result = {}
+        for path in include:
+            value = _get_path(doc, path, _MISSING)
+            if value is not _MISSING:
+                _set_path(result, path, value)
+        if fields.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+
+    result = copy.deepcopy(doc)
+    for path, v in fields.iteritems():
+        if not v:
+            _unset_path(result, path)
+    return result
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _convert(value, as_class):
+    if isinstance(value, dict):
+        return as_class((k, _convert(v, as_class))
+                        for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_convert(v, as_class) for v in value]
+    return value
+
+
+def sort_documents(docs, sort):
+    for key, direction in reversed(list(sort or [])):
+        docs.sort(key=lambda d: _get_path(d, key),
+                  reverse=direction in (-1, 'desc', 'descending'))
+    return docs
+
+
+def _evaluate(doc, expression):
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        return _get_path(doc, expression[1:])
+    if isinstance(expression, dict):
+        return dict((k, _evaluate(doc, v)) for k, v in expression.iteritems())
+    return expression
+
+
+def _accumulate(op, values):
+    if op == '$sum':
+        return sum(v for v in values if isinstance(v, (int, long, float)))
+    if op == '$avg':
+        numbers = [v for v in values if isinstance(v, (int, long, float))]
+        return float(sum(numbers)) / len(numbers) if numbers else None
+    values = [v for v in values if v is not None]
+    if op == '$min':
+        return min(values) if values else None
+    if op == '$max':
+        return max(values) if values else None
+    if op == '$first':
+        return values[0] if values else None
+    if op == '$last':
+        return values[-1] if values else None
+    if op == '$push':
+        return values
+    if op == '$addToSet':
+        return [v for i, v in enumerate(values) if v not in values[:i]]
+    raise ORMException("Accumulator %s is not supported in memory" % op)
+
+
+def run_pipeline(docs, pipeline):
+    for stage in pipeline:
+        (op, spec), = stage.items()
+
+        if op == '$match':
+            docs = [d for d in docs if matches(d, spec)]
+        elif op == '$sort':
+            docs = sort_documents(docs, spec.items())
+        elif op == '$skip':
+            docs = docs[spec:]
+        elif op == '$limit':
+            docs = docs[:spec]
+        elif op == '$unwind':
+            path = spec[1:]
+            unwound = []
+            for d in docs:
+                for item in _get_path(d, path) or []:
+                    d = copy.deepcopy(d)
+                    _set_path(d, path, item)
+                    unwound.append(d)
+            docs = unwound
+        elif op == '$project':
+            flags = dict((k, v) for k, v in spec.iteritems()
+                         if v in (0, 1) or isinstance(v, bool))
+            projected = []
+            for d in docs:
+                result = project(d, flags) if flags else \
+                    {'_id': d.get('_id')}
+                for k, v in spec.iteritems():
+                    if k not in flags:
+                        _set_path(result, k, _evaluate(d, v))
+                projected.append(result)
+            docs = projected
+        elif op == '$group':
+            groups = OrderedDict()
+            for d in docs:
+                key = _evaluate(d, spec['_id'])
+                groups.setdefault(repr(key), (key, []))[1].append(d)
+
+            docs = []
+            for key, members in groups.itervalues():
+                result = {'_id': key}
+                for field, accumulator in spec.iteritems():
+                    if field == '_id':
+                        continue
+                    (acc, expression), = accumulator.items()
+                    result[field] = _accumulate(
+                        acc, [_evaluate(d, expression) for d in members])
+                docs.append(result)
+        else:
+            raise ORMException(
+                "Pipeline stage %s is not supported in memory" % op)
+
+    return docs
+
+
+class MemoryCursor(object):
+
+    def __init__(self, collection, spec=None, fields=None, sort=None,
+                 limit=0, skip=0, as_class=dict, **kwargs):
+        self.collection = collection
+        self.spec = spec or {}
+        self.fields = fields
+        self.as_class = as_class
+        self._sort = list(sort or [])
+        self._limit = limit or 0
+        self._skip = skip or 0
+        self._results = None
+
+    def _documents(self):
+        if self._results is None:
+            with self.collection.lock:
+                docs = [d for d in self.collection.documents.itervalues()
+                        if matches(d, self.spec)]
+            sort_documents(docs, self._sort)
+            self._matched = len(docs)
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            self._results = [_convert(project(d, self.fields), self.as_class)
+                             for d in docs]
+        return self._results
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self._documents())
+        self._documents()
+        return self._matched
+
+    def explain(self):
+        docs = self._documents()
+        return {
+            'cursor': 'MemoryCursor',
+            'nscanned': len(self.collection.documents),
+            'nscannedObjects': len(self.collection.documents),
+            'n': len(docs),
+            'indexBounds': {}
+        }
+
+    def __getitem__(self, index):
+        return self._documents()[index]
+
+    def __iter__(self):
+        return iter(self._documents())
+
+    def __len__(self):
+        return len(self._documents())
+
+
+class MemoryCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = OrderedDict()
+        self.lock = threading.RLock()
+
+    def insert(self, doc_or_docs, manipulate=True, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) \
+            else [doc_or_docs]
+
+        ids = []
+        with self.lock:
+            for doc in docs:
+                if '_id' not in doc:
+                    doc['_id'] = ObjectId()
+                if _hashable(doc['_id']) in self.documents:
+                    raise pymongo.errors.DuplicateKeyError(
+                        "E11000 duplicate key error index: %s.%s.$_id_ "
+                        "dup key: { : \"%s\" }"
+                        % (self.database.name, self.name, doc['_id']))
+                self.documents[_hashable(doc['_id'])] = _convert(doc, dict)
+                ids.append(doc['_id'])
+
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def save(self, to_save, **kwargs):
+        with self.lock:
+            if '_id' not in to_save:
+                return self.insert(to_save)
+            self.documents[_hashable(to_save['_id'])] = _convert(to_save, dict)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        n = 0
+        with self.lock:
+            for doc in self.documents.values():
+                if matches(doc, spec):
+                    apply_update(doc, document)
+                    n += 1
+                    if not multi:
+                        break
+
+            if not n and upsert:
+                doc = dict((k, v) for k, v in spec.iteritems()
+                           if not k.startswith('$') and not (
+                               isinstance(v, dict) and v and
+                               all(o.startswith('$') for o in v)))
+                apply_update(doc, document)
+                self.insert(doc)
+                n = 1
+
+        return {'n': n, 'ok': 1.0, 'err': None, 'updatedExisting': bool(n)}
+
+    def remove(self, spec_or_id=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+
+        with self.lock:
+            ids = [k for k, d in self.documents.iteritems()
+                   if matches(d, spec_or_id)]
+            for _id in ids:
+                del self.documents[_id]
+
+        return {'n': len(ids), 'ok': 1.0, 'err': None}
+
+    def find(self, spec=None, *args, **kwargs):
+        return MemoryCursor(self, spec, *args, **kwargs)
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        kwargs['limit'] = 1
+        return next(iter(self.find(spec_or_id, *args, **kwargs)), None)
+
+    def find_and_modify(self, query=None, update=None, upsert=False,
+                        sort=None, full_response=False, new=False,
+                        fields=None, remove=False, **kwargs):
+        if isinstance(sort, dict):
+            sort = sort.items()
+
+        with self.lock:
+            docs = [d for d in self.documents.itervalues()
+                    if matches(d, query)]
+            sort_documents(docs, sort)
+
+            if not docs:
+                if not upsert or remove:
+                    return None
+                self.update(query, update, upsert=True)
+                return self.find_one(query, fields) if new else None
+
+            doc = docs[0]
+            before = copy.deepcopy(doc)
+            if remove:
+                del self.documents[_hashable(doc['_id'])]
+            else:
+                apply_update(doc, update)
+
+            return project(copy.deepcopy(doc if new and not remove
+                                         else before), fields)
+
+    def count(self):
+        return len(self.documents)
+
+    def aggregate(self, pipeline, **kwargs):
+        with self.lock:
+            docs = copy.deepcopy(self.documents.values())
+        result = run_pipeline(docs, pipeline)
+
+        if 'cursor' in kwargs:
+            return iter(result)
+        return {'result': result, 'ok': 1.0}
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    create_index = ensure_index
+
+    def drop(self):
+        with self.lock:
+            self.documents.clear()
+
+
+class MemoryDatabase(object):
+
+    def __init__(self, name='memory'):
+        self.__dict__['name'] = name
+        self.__dict__['collections'] = {}
+        self.__dict__['lock'] = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(self, name)
+            return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+
+register_database_type(MemoryDatabase)
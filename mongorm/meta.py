@@ -1,3 +1,7 @@
+import copy
+import weakref
+import copy_reg
+
 OnModelInit = None
 
 def pack(_val):
@@ -13,6 +17,201 @@ def pack(_val):
     return _val
 
 
+MISSING = object()
+
+
+def _format(t, dbdict=False):
+    if isinstance(t, (DbDictClass, dict)):
+        _obj = {} if not dbdict else DbDictClass({})
+        for k, v in t.iteritems():
+            _obj[k] = _format(v, dbdict=dbdict)
+        return _obj
+    elif isinstance(t, list):
+        return [_format(x, dbdict=dbdict) for x in t]
+    elif isinstance(t, Snapshot):
+        return t.to_dict()
+    return t
+
+
+def _snapshots(obj):
+    state = object.__getattribute__(obj, '__dict__')
+    refs = state.get('_snapshots')
+    alive = [s for s in (r() for r in refs or ()) if s is not None]
+
+    if not alive:
+        state.pop('_snapshots', None)
+        if isinstance(obj, _Tracking):
+            object.__setattr__(obj, '__class__', type(obj).__untracked__)
+    elif len(alive) != len(refs):
+        refs[:] = [weakref.ref(s) for s in alive]
+    return alive
+
+
+def _record(obj, keys):
+    if not isinstance(obj, _Tracking):
+        return
+
+    snapshots = _snapshots(obj)
+    for key in keys:
+        for snapshot in snapshots:
+            if key not in snapshot._saved:
+                snapshot._saved[key] = dict.get(obj, key, MISSING)
+
+
+def _freeze(value):
+    '''
+    Returns the state of `value` for a snapshot to keep. DbDictClass
+    values are snapshotted, lists and plain dicts are copied level by
+    level keeping their types.
+    '''
+    if isinstance(value, DbDictClass):
+        return value.snapshot()
+
+    if isinstance(value, dict):
+        frozen = copy.copy(value)
+        for k, v in value.iteritems():
+            frozen[k] = _freeze(v)
+        return frozen
+
+    if isinstance(value, list):
+        frozen = copy.copy(value)
+        for i, v in enumerate(value):
+            frozen[i] = _freeze(v)
+        return frozen
+
+    return value
+
+
+def _share(obj, key, value):
+    pending = [s for s in _snapshots(obj) if key not in s._saved]
+    if pending:
+        saved = _freeze(value)
+        for snapshot in pending:
+            snapshot._saved[key] = saved
+    return value
+
+
+class Snapshot(object):
+    '''
+    Read-only view of a DbDictClass as it was when snapshot() was taken.
+
+    Nothing is copied up front. The live object hands its previous value
+    to the snapshot the first time a key is overwritten, and nested
+    DbDictClass values get a snapshot of their own the first time they
+    are read through the parent, before they can be mutated in place.
+    Lists and plain dicts cannot track their items, so the snapshot keeps
+    a copy of them taken on first access; the live object keeps the
+    originals.
+
+    Mutations that bypass the parent, e.g. through a reference held from
+    before the snapshot or via values()/items(), are not tracked.
+    '''
+
+    def __init__(self, source):
+        self._source = source
+        self._saved = {}
+
+    def __getitem__(self, key):
+        if key not in self._saved:
+            value = dict.get(self._source, key, MISSING)
+            if isinstance(value, (dict, list)):
+                # Route through the live object so the snapshot keeps a
+                # copy before it can be changed in place.
+                value = self._source[key]
+            if key not in self._saved:
+                if value is MISSING:
+                    raise KeyError(key)
+                return value
+
+        value = self._saved[key]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def keys(self):
+        keys = set(self._source.keys())
+        for key, value in self._saved.iteritems():
+            if value is MISSING:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        '''
+        Materialises the snapshot as plain dicts and lists.
+        '''
+        return dict((k, v.to_dict() if isinstance(v, Snapshot)
+                     else _format(v)) for k, v in self.iteritems())
+
+    def diff(self, prefix=''):
+        '''
+        Returns {dotted.path: (before, after)} for every value which
+        differs between the snapshot and the live object. MISSING marks
+        keys which do not exist on one side. Only keys touched since the
+        snapshot are compared.
+        '''
+        changes = {}
+        for key, old in self._saved.iteritems():
+            path = prefix + key
+            new = dict.get(self._source, key, MISSING)
+
+            if isinstance(old, Snapshot):
+                if new is old._source:
+                    changes.update(old.diff(path + '.'))
+                    continue
+                old = old.to_dict()
+
+            if old is new:
+                continue
+            if isinstance(old, (dict, list)):
+                old = _format(old)
+            if old is MISSING or new is MISSING or \
+               _format(old) != _format(new):
+                changes[path] = (old, new)
+
+        return changes
+
+    def release(self):
+        '''
+        Stops tracking the live object. Later reads reflect its current
+        state.
+        '''
+        refs = object.__getattribute__(self._source, '__dict__') \
+            .get('_snapshots') or []
+        refs[:] = [r for r in refs if r() not in (None, self)]
+        self._saved.clear()
+        _snapshots(self._source)
+
+
 class DbDictClass(dict):
 
     def __getattribute__(self, key):
@@ -28,23 +227,106 @@ class DbDictClass(dict):
     def __delattr__(self, key):
         self.pop(key)
 
+    def snapshot(self):
+        '''
+        Returns a Snapshot of the current state in O(1).
+        '''
+        snapshot = Snapshot(self)
+        state = object.__getattribute__(self, '__dict__')
+        state.setdefault('_snapshots', []).append(weakref.ref(snapshot))
+
+        cls = type(self)
+        if not issubclass(cls, _Tracking):
+            tracked = _TRACKED.get(cls)
+            if tracked is None:
+                tracked = type(cls)(cls.__name__, (_Tracking, cls),
+                                    {'__dyn__': True, '__untracked__': cls,
+                                     '__module__': cls.__module__})
+                _TRACKED[cls] = tracked
+            object.__setattr__(self, '__class__', tracked)
+
+        return snapshot
+
     def copy(self, dbdict=False):
         if dbdict:
-            print "DbDict copy is expensive."
-
-        def _format(t, dbdict=False):
-            if isinstance(t, (DbDictClass, dict)):
-                _obj = {} if not dbdict else DbDictClass({})
-                for k, v in t.iteritems():
-                    _obj[k] = _format(v, dbdict=dbdict)
-                return _obj
-            elif isinstance(t, list):
-                return [_format(x, dbdict=dbdict) for x in t]
-            return t
+            print "DbDict copy is expensive. Consider snapshot()."
 
         return _format(self, dbdict=dbdict)
 
 
+_TRACKED = {}
+
+
+class _Tracking(object):
+    '''
+    Copy-on-write hooks. A DbDictClass instance is switched to a subclass
+    with these mixed in while it has live snapshots, so untracked
+    instances keep dict speed.
+    '''
+
+    def __getattribute__(self, key):
+        if key == 'update' and not dict.__contains__(self, key):
+            # Not a method named update: ModelBase pins dict.update on
+            # instances and its classmethod update must stay reachable.
+            return object.__getattribute__(self, '_tracked_update')
+
+        value = super(_Tracking, self).__getattribute__(key)
+        if isinstance(value, (dict, list)) and \
+           dict.get(self, key, MISSING) is value:
+            value = _share(self, key, value)
+        return value
+
+    def _tracked_update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        _record(self, other)
+        dict.update(self, other)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, (dict, list)):
+            value = _share(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        _record(self, [key])
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        _record(self, [key])
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *args):
+        _record(self, [key])
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(iter(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        _record(self, self.keys())
+        dict.clear(self)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as the untracked class, without the snapshot references.
+        state = dict(object.__getattribute__(self, '__dict__'))
+        state.pop('_snapshots', None)
+        return (copy_reg._reconstructor,
+                (type(self).__untracked__, dict, dict(self)), state or None)
+
+
 class ModelDefinition(DbDictClass):
     __baseclass__ = True
 
@@ -61,18 +343,22 @@ class ModelDefinition(DbDictClass):
         raise NotImplementedError
 
     @classmethod
-    def insert(cls, document):
+    def insert(cls, document, timeout=None):
         raise NotImplementedError
 
     @classmethod
-    def aggregate(cls, commands):
+    def aggregate(cls, commands, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def pipeline(cls):
         raise NotImplementedError
 
     @classmethod
     def group(cls, *args, **kwargs):
         raise NotImplementedError
 
-    def save(self, validate=True):
+    def save(self, validate=True, timeout=None):
         raise NotImplementedError
 
     @classmethod
@@ -91,6 +377,10 @@ class ModelDefinition(DbDictClass):
     def get_many(cls, *args, **kwargs):
         raise NotImplementedError
 
+    @classmethod
+    def get_records(cls, *args, **kwargs):
+        raise NotImplementedError
+
     @classmethod
     def remove(cls, _id, *args, **kwargs):
         raise NotImplementedError
@@ -106,6 +396,17 @@ class DataTypeDefinition(object):
     def dbfy(self, value):
         raise NotImplementedError
 
+
+class ViewDefinition(object):
+    name = None
+
+    def apply(self, model, database, before, after):
+        raise NotImplementedError
+
+    def rebuild(self, model):
+        raise NotImplementedError
+
+
 class ModelMeta(type):
 
     def get_field_defaults(cls, field):
@@ -116,6 +417,11 @@ class ModelMeta(type):
 
     def attach_fields(cls, model):
         for (field_name, obj) in vars(model).items():
+            if isinstance(obj, ViewDefinition):
+                obj.name = obj.name or field_name
+                cls.__views__[field_name] = obj
+                continue
+
             if not isinstance(obj, DataTypeDefinition):
                 continue
 
@@ -143,6 +449,7 @@ class ModelMeta(type):
         cls.choices = {}
         cls.required_fields = set()
         cls.searchable_fields = []
+        cls.__views__ = {}
 
         if not attrs.get('__baseclass__') and attrs.get("__tablename__"):
             if callable(OnModelInit):
@@ -167,6 +474,7 @@ class ModelMeta(type):
                 cls.defaults.update(model.defaults)
                 cls.required_fields.update(model.required_fields)
                 cls.searchable_fields.extend(model.searchable_fields)
+                cls.__views__.update(model.__views__)
 
             else:
                 cls.attach_fields(model)
@@ -0,0 +1,273 @@
+import time
+import logging
+import threading
+
+from .errors import ORMException
+from .datatypes import Integer
+
+_UPGRADES = {}
+
+log = logging.getLogger(__name__)
+
+
+def upgrade(from_version, renames=None):
+    '''
+    Marks a model function as the upgrade from `from_version` to the next
+    version. It receives the model class and the raw document and returns
+    the upgraded document (or None after changing it in place).
+
+    `renames` maps old field names to new ones so queries on the new name
+    keep matching documents which have not been upgraded yet.
+    '''
+    def decorator(func):
+        func.upgrade_from = from_version
+        func.renames = dict(renames or {})
+        return func
+    return decorator
+
+
+class MigratingCursor(object):
+    '''
+    Wraps a pymongo cursor and upgrades documents as they are read.
+    '''
+
+    def __init__(self, model, cursor, write_back):
+        self.model = model
+        self.cursor = cursor
+        self.write_back = write_back
+
+    def _upgrade(self, document):
+        return self.model.upgrade_document(document,
+                                           write_back=self.write_back)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MigratingCursor(self.model, self.cursor[index],
+                                   self.write_back)
+        return self._upgrade(self.cursor[index])
+
+    def __iter__(self):
+        for document in self.cursor:
+            yield self._upgrade(document)
+
+    def next(self):
+        return self._upgrade(self.cursor.next())
+
+    def __getattr__(self, key):
+        return getattr(self.cursor, key)
+
+
+class MigratingMixin(object):
+    '''
+    Versioned schema with upgrades applied when documents are loaded.
+
+        class User(MigratingMixin, ModelBase):
+            __tablename__ = "user"
+            __schema_version__ = 1
+
+            full_name = Unichar()
+
+            @upgrade(0, renames={'name': 'full_name'})
+            def rename_name(cls, document):
+                document['full_name'] = document.pop('name', None)
+
+    Documents without schema_version are at version 0. Upgraded documents
+    are written back when read, guarded by their old version so
+    concurrent readers do not clobber each other; reads with a field
+    projection are upgraded in memory only. A failed write back, e.g. an
+    upgrade producing an invalid value, is logged and does not fail the
+    read; the stored document stays at its old version until a later
+    read or migrate() upgrades it. migrate() rewrites the
+    remaining documents in throttled batches. Queries on renamed fields
+    also match documents still stored under the old name.
+    '''
+
+    __schema_version__ = 0
+    __migrate_on_read__ = True
+
+    schema_version = Integer(default=0)
+
+    @classmethod
+    def upgrades(cls):
+        upgrades = _UPGRADES.get(cls)
+        if upgrades is None:
+            upgrades = {}
+            for klass in reversed(cls.__mro__):
+                for value in vars(klass).itervalues():
+                    if hasattr(value, 'upgrade_from'):
+                        upgrades[value.upgrade_from] = value
+            _UPGRADES[cls] = upgrades
+        return upgrades
+
+    @classmethod
+    def field_versions(cls, field):
+        '''
+        Returns [(name, [versions])] naming `field` at each version.
+        '''
+        upgrades = cls.upgrades()
+        names = []
+        name = field
+        for version in xrange(cls.__schema_version__, -1, -1):
+            if names and names[-1][0] == name:
+                names[-1][1].append(version)
+            else:
+                names.append((name, [version]))
+
+            renames = getattr(upgrades.get(version - 1), 'renames', {})
+            for old, new in renames.iteritems():
+                if new == name:
+                    name = old
+                    break
+        return names
+
+    @classmethod
+    def _version_query(cls, filter_args):
+        for key in [k for k in filter_args if not k.startswith('$')]:
+            names = cls.field_versions(key.split('.')[0])
+            if len(names) == 1:
+                continue
+
+            suffix = key[len(key.split('.')[0]):]
+            condition = filter_args.pop(key)
+            clauses = []
+            for name, versions in names:
+                if 0 in versions:
+                    versions = versions + [None]
+                clauses.append({name + suffix: condition,
+                                'schema_version': {'$in': versions}})
+
+            filter_args.setdefault('$and', []).append({'$or': clauses})
+
+    @classmethod
+    def prepare_get_query(cls, filter_args):
+        super(MigratingMixin, cls).prepare_get_query(filter_args)
+        cls._version_query(filter_args)
+
+    @classmethod
+    def prepare_update_query(cls, filter_args):
+        super(MigratingMixin, cls).prepare_update_query(filter_args)
+        cls._version_query(filter_args)
+
+    @classmethod
+    def prepare_insert_document(cls, document):
+        super(MigratingMixin, cls).prepare_insert_document(document)
+        document['schema_version'] = cls.__schema_version__
+
+    @classmethod
+    def upgrade_document(cls, document, write_back=False):
+        original = document.get('schema_version') or 0
+        if original >= cls.__schema_version__:
+            return document
+
+        keys = set(document)
+        upgrades = cls.upgrades()
+        for version in xrange(original, cls.__schema_version__):
+            func = upgrades.get(version)
+            if func is None:
+                raise ORMException(
+                    "%s has no upgrade from schema version %d"
+                    % (cls.__name__, version))
+
+            result = func(cls, document)
+            if result is not None:
+                document = result
+
+        document['schema_version'] = cls.__schema_version__
+        if write_back and '_id' in document:
+            try:
+                cls.write_upgraded(document, original, keys - set(document))
+            except Exception:
+                log.exception("Could not write back %s %s upgraded from "
+                              "schema version %d", cls.__name__,
+                              document['_id'], original)
+        return document
+
+    @classmethod
+    def write_upgraded(cls, document, version, removed=()):
+        '''
+        Stores an upgraded document unless another writer changed its
+        version meanwhile. Returns True if it was written.
+        '''
+        values = dict(document)
+        values.pop('_id')
+        cls.validate_type(values, check_required=False)
+
+        update = {'$set': values}
+        if removed:
+            update['$unset'] = dict((k, 1) for k in removed)
+
+        call = cls.mongo_collection(cls.database_for(document))
+        result = call.update(
+            {'_id': document['_id'],
+             'schema_version': {'$in': [version, None] if not version
+                                else [version]}},
+            update)
+        return bool((result or {}).get('n'))
+
+    @classmethod
+    def _get(cls, *args, **kwargs):
+        fields = kwargs.get('fields')
+        projected = fields is not None
+        if isinstance(fields, list):
+            # Fetch renamed fields under their old names as well.
+            extra = ['schema_version']
+            for field in fields:
+                extra.extend(name for name, _ in cls.field_versions(field))
+            kwargs['fields'] = list(set(fields + extra))
+
+        cursor = super(MigratingMixin, cls)._get(*args, **kwargs)
+        return MigratingCursor(
+            cls, cursor, cls.__migrate_on_read__ and not projected)
+
+    @classmethod
+    def migrate(cls, batch_size=100, pause=0.1, limit=None):
+        '''
+        Upgrades stored documents in batches of `batch_size`, sleeping
+        `pause` seconds between batches. Documents which fail to upgrade
+        or to validate are logged and left at their old version. Returns
+        the number upgraded.
+        '''
+        current = cls.__schema_version__
+        query = {'$or': [{'schema_version': {'$lt': current}},
+                         {'schema_version': None}]}
+        call = cls.mongo_collection(cls.valid_database())
+
+        migrated = 0
+        # Documents another writer got to first or which failed, kept to
+        # avoid looping.
+        skipped = set()
+        while limit is None or migrated < limit:
+            cursor = call.find(query, limit=batch_size + len(skipped))
+            batch = [d for d in cursor if d['_id'] not in skipped]
+            if not batch:
+                break
+
+            for document in batch:
+                _id = document['_id']
+                version = document.get('schema_version') or 0
+                keys = set(document)
+                try:
+                    document = cls.upgrade_document(document)
+                    written = cls.write_upgraded(document, version,
+                                                 keys - set(document))
+                except Exception:
+                    log.exception("Could not migrate %s %s from schema "
+                                  "version %d", cls.__name__, _id, version)
+                    written = False
+
+                if written:
+                    migrated += 1
+                else:
+                    skipped.add(_id)
+
+            time.sleep(pause)
+
+        return migrated
+
+    @classmethod
+    def migrate_in_background(cls, **kwargs):
+        thread = threading.Thread(target=cls.migrate, kwargs=kwargs,
+                                  name='%s-migrate' % cls.__name__)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,228 @@
+import time
+import uuid
+import random
+import datetime
+
+from .errors import ORMException
+from .datatypes import Unichar, Integer, Datetime
+
+QUEUED = u'queued'
+LEASED = u'leased'
+DONE = u'done'
+FAILED = u'failed'
+
+
+class Backoff(object):
+    '''
+    Exponential backoff with jitter used while polling an empty queue.
+    '''
+
+    def __init__(self, min_wait=0.05, max_wait=5.0, factor=2.0):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.factor = factor
+        self.current = 0
+
+    def reset(self):
+        self.current = 0
+
+    def next(self):
+        if not self.current:
+            self.current = self.min_wait
+        else:
+            self.current = min(self.current * self.factor, self.max_wait)
+        return random.uniform(self.current / 2, self.current)
+
+
+class QueueMixin(object):
+    '''
+    Turns a model into a work queue.
+
+    Mix in ahead of ModelBase. Jobs are claimed under a lease which expires
+    after `lease` seconds, at which point the job becomes visible to other
+    workers again unless the lease is renewed.
+
+        class Job(QueueMixin, ModelBase):
+            __tablename__ = "job"
+            payload = Dict()
+
+    With __queue_max_attempts__ set, jobs which used up their attempts
+    are no longer claimed. fail_exhausted() moves them to FAILED once
+    they are no longer leased; poll() runs it whenever the queue is
+    idle, otherwise call it periodically.
+    '''
+
+    __queue_max_attempts__ = None
+
+    queue_state = Unichar(default=QUEUED)
+    priority = Integer(default=0)
+    attempts = Integer(default=0)
+    lease_owner = Unichar()
+    lease_token = Unichar()
+    lease_expires = Datetime()
+
+    @classmethod
+    def claimable_query(cls, now, filter_args=None):
+        query = dict(filter_args or {})
+        query['deleted'] = False
+        claimable = [
+            {'queue_state': QUEUED},
+            {'queue_state': LEASED, 'lease_expires': {'$lt': now}}
+        ]
+        if '$or' in query:
+            # Keep the caller's $or, both have to hold.
+            query['$and'] = query.get('$and', []) + [
+                {'$or': query.pop('$or')}, {'$or': claimable}]
+        else:
+            query['$or'] = claimable
+
+        if cls.__queue_max_attempts__ is not None:
+            query['attempts'] = {'$lt': cls.__queue_max_attempts__}
+
+        return query
+
+    @classmethod
+    def fail_exhausted(cls, now=None):
+        '''
+        Moves jobs that reached __queue_max_attempts__ and are not held
+        by a live lease to FAILED. Returns the number of jobs moved.
+        '''
+        if cls.__queue_max_attempts__ is None:
+            return 0
+
+        query = cls.claimable_query(now or cls.now())
+        query['attempts'] = {'$gte': cls.__queue_max_attempts__}
+        result = cls.update(query, {'$set': {'queue_state': FAILED}},
+                            silent=True)
+        return (result or {}).get('n', 0)
+
+    @classmethod
+    def claim(cls, limit=1, lease=30, owner=None, filter_args=None,
+              sort=-1, sortkey='priority'):
+        '''
+        Claims up to `limit` jobs, highest priority first by default.
+
+        A single job is claimed atomically with find_and_modify. Larger
+        batches take three round trips regardless of `limit`: candidate
+        lookup, a conditional multi update stamping a lease token, and a
+        fetch by that token. Jobs lost to a concurrent worker between the
+        first two steps are simply not returned.
+        '''
+        if limit < 1:
+            raise ORMException("Claim limit must be a positive number")
+
+        _sort = cls.sort_spec(sort, sortkey)
+        now = cls.now()
+        query = cls.claimable_query(now, filter_args)
+        token = unicode(uuid.uuid4().hex)
+        document = {
+            '$set': {
+                'queue_state': LEASED,
+                'lease_owner': owner and unicode(owner),
+                'lease_token': token,
+                'lease_expires': now + datetime.timedelta(seconds=lease)
+            },
+            '$inc': {'attempts': 1}
+        }
+
+        if limit == 1:
+            job = cls.find_and_modify(query, document, sort=_sort, new=True,
+                                      silent=True)
+            return [cls(partial_model=True, **job)] if job else []
+
+        candidates = cls._get(dict(query), limit=limit, sort=_sort.items(),
+                              fields=['_id'])
+        ids = [c['_id'] for c in candidates]
+        if not ids:
+            return []
+
+        query['_id'] = {'$in': ids}
+        cls.update(query, document, silent=True)
+
+        jobs = cls._get({'_id': {'$in': ids}, 'lease_token': token},
+                        sort=_sort.items())
+        return [cls(partial_model=True, **claimed) for claimed in jobs]
+
+    @classmethod
+    def poll(cls, limit=1, lease=30, owner=None, filter_args=None,
+             backoff=None, idle_timeout=None, **kwargs):
+        '''
+        Yields batches of claimed jobs. Sleeps with exponential backoff
+        while the queue is empty and stops once it has stayed empty for
+        `idle_timeout` seconds.
+        '''
+        backoff = backoff or Backoff()
+        idle_since = None
+
+        while True:
+            jobs = cls.claim(limit=limit, lease=lease, owner=owner,
+                             filter_args=filter_args, **kwargs)
+            if jobs:
+                backoff.reset()
+                idle_since = None
+                yield jobs
+                continue
+
+            if idle_since is None:
+                idle_since = time.time()
+                cls.fail_exhausted()
+            if idle_timeout is not None and \
+               time.time() - idle_since >= idle_timeout:
+                return
+
+            time.sleep(backoff.next())
+
+    @classmethod
+    def _lease_update(cls, jobs, document):
+        by_token = {}
+        for job in jobs:
+            by_token.setdefault(job.lease_token, []).append(job._id)
+
+        updated = 0
+        for token, ids in by_token.iteritems():
+            result = cls.update(
+                {'_id': {'$in': ids}, 'lease_token': token,
+                 'queue_state': LEASED},
+                document, silent=True)
+            updated += (result or {}).get('n', 0)
+
+        return updated
+
+    @classmethod
+    def complete_many(cls, jobs):
+        return cls._lease_update(jobs, {'$set': {'queue_state': DONE}})
+
+    @classmethod
+    def release_many(cls, jobs):
+        return cls._lease_update(jobs, {'$set': {'queue_state': QUEUED}})
+
+    @classmethod
+    def fail_many(cls, jobs):
+        return cls._lease_update(jobs, {'$set': {'queue_state': FAILED}})
+
+    def renew(self, lease=30):
+        '''
+        Extends the lease on a claimed job. Returns False if the lease was
+        lost to another worker.
+        '''
+        # NOTE: self.update is dict.update on model instances.
+        expires = self.now() + datetime.timedelta(seconds=lease)
+        result = self.__class__.update(
+            {'_id': self._id, 'lease_token': self.lease_token,
+             'queue_state': LEASED},
+            {'$set': {'lease_expires': expires}}, silent=True)
+
+        if not (result or {}).get('n'):
+            return False
+
+        self.lease_expires = expires
+        return True
+
+    def complete(self):
+        return bool(self.complete_many([self]))
+
+    def release(self):
+        return bool(self.release_many([self]))
+
+    def fail(self):
+        return bool(self.fail_many([self]))
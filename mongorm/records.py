@@ -0,0 +1,68 @@
+import threading
+from operator import itemgetter
+
+from .errors import ORMException
+
+_RECORD_CLASSES = {}
+_LOCK = threading.Lock()
+
+# Stored by insert, save, update and remove without being declared.
+TIMESTAMP_FIELDS = ('created_on', 'modified_on', 'updated_on', 'deleted_on')
+
+
+def _names(model, fields):
+    names = []
+    for field in list(fields) + ['_id']:
+        name = field.split('.')[0]
+        if name not in model.fields and name not in TIMESTAMP_FIELDS:
+            raise ORMException(
+                '''
+                Invalid projection on %s in %s
+                ''' % (name, model.__tablename__))
+        if name not in names:
+            names.append(name)
+    return tuple(names)
+
+
+def _build(model, names):
+    def _make(cls, document, _new=tuple.__new__, _names=names):
+        get = document.get
+        return _new(cls, [get(name) for name in _names])
+
+    def _asdict(self):
+        return dict(zip(names, self))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in zip(names, self)))
+
+    attrs = {
+        '__slots__': (),
+        '__module__': model.__module__,
+        '_fields': names,
+        '_make': classmethod(_make),
+        '_asdict': _asdict,
+        '__repr__': __repr__
+    }
+    for index, name in enumerate(names):
+        attrs[name] = property(itemgetter(index))
+
+    return type('%sRecord' % model.__name__, (tuple,), attrs)
+
+
+def record_class(model, fields):
+    '''
+    Returns the read-only record class for a projection of `model`. The
+    class is a tuple subclass without instance dicts, with one property
+    per projected top-level field, and is cached per projection shape.
+    '''
+    names = _names(model, fields)
+    key = (model, names)
+
+    record = _RECORD_CLASSES.get(key)
+    if record is None:
+        with _LOCK:
+            record = _RECORD_CLASSES.get(key)
+            if record is None:
+                record = _RECORD_CLASSES[key] = _build(model, names)
+    return record
@@ -0,0 +1,425 @@
+import zlib
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import bson
+
+from . import deadline
+from .errors import ORMException
+from .base import ModelBase, DATABASE_TYPES
+from .datatypes import DataType
+
+_routing = threading.local()
+_pool = [None]
+_pool_lock = threading.Lock()
+
+
+def _thread_pool(size):
+    with _pool_lock:
+        if _pool[0] is None:
+            _pool[0] = ThreadPool(size)
+    return _pool[0]
+
+
+def _routes():
+    # Routing is per model class, so routing one model does not route
+    # another inside the same block.
+    routes = getattr(_routing, 'databases', None)
+    if routes is None:
+        routes = _routing.databases = {}
+    return routes
+
+
+def _value(document, path):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def _query(filter_args, kwargs):
+    query = dict(filter_args) if isinstance(filter_args, dict) else {}
+    query.update((k, v) for k, v in kwargs.iteritems() if k not in (
+        'limit', 'skip', 'sort', 'sortkey', 'max_scan', 'fields',
+        'as_class', 'timeout'))
+    return query
+
+
+def _sort(documents, spec):
+    for key, direction in reversed(spec):
+        documents.sort(key=lambda d: _value(d, key),
+                       reverse=direction in (-1, 'desc', 'descending'))
+    return documents
+
+
+class ScatterCursor(object):
+    '''
+    Merged results of a query sent to several shards. Supports the parts
+    of the pymongo cursor interface that ModelBase callers rely on.
+    '''
+
+    def __init__(self, documents, counts):
+        self.documents = documents
+        self._counts = counts
+        self._count = None
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self.documents)
+        if self._count is None:
+            self._count = sum(self._counts())
+        return self._count
+
+    def __getitem__(self, index):
+        return self.documents[index]
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+
+class ShardedModel(ModelBase):
+    '''
+    Partitions a model across several databases on a shard key.
+
+        class Event(ShardedModel):
+            __tablename__ = "event"
+            __shardkey__ = "tenant"
+
+            tenant = Unichar(nullable=False)
+
+            @classmethod
+            def shards(cls):
+                return [client_a.events, client_b.events]
+
+    Documents are placed by a stable hash of the shard key. Inserts and
+    saves require the shard key. Queries with the shard key as a value or
+    an $in list go to the owning shards only; other queries are sent to
+    every shard in parallel and merged with sort, skip and limit applied
+    across shards. Operations that cannot be merged, like aggregate or
+    find_and_modify without the shard key, must be routed explicitly:
+
+        with Event.on_shard(database):
+            Event.aggregate(...)
+
+    Routing applies to the model it is entered for and its subclasses.
+    The shard key of a stored document cannot be changed.
+    '''
+    __baseclass__ = True
+    __shardkey__ = None
+    __scatter_threads__ = 16
+
+    @classmethod
+    def shards(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def using(cls):
+        routes = _routes()
+        for klass in cls.__mro__:
+            if klass in routes:
+                return routes[klass]
+        return None
+
+    @classmethod
+    def valid_database(cls):
+        database = cls.using()
+        if database is None:
+            raise ORMException(
+                '''
+                Error in model %s. Operation is not routed to a shard.
+                Include %s in the query or use %s.on_shard(database).
+                ''' % (cls.__name__, cls.__shardkey__, cls.__name__))
+
+        if not isinstance(database, tuple(DATABASE_TYPES)):
+            raise ORMException(
+                '''
+                Error in model %s.
+                Shards must be of type pymongo.database.Database
+                ''' % cls.__name__)
+
+        return database
+
+    @classmethod
+    @contextmanager
+    def on_shard(cls, database):
+        routes = _routes()
+        previous = routes.get(cls)
+        routes[cls] = database
+        try:
+            yield database
+        finally:
+            if previous is None:
+                routes.pop(cls, None)
+            else:
+                routes[cls] = previous
+
+    @classmethod
+    def routed(cls):
+        return cls.using() is not None
+
+    @classmethod
+    def database_for(cls, document):
+        if cls.routed():
+            return cls.valid_database()
+        return cls.shard_for(cls._shard_key_of(document))
+
+    @classmethod
+    def shard_for(cls, value):
+        # BSON stores int as int32 and long as int64, and the server
+        # matches 5 and 5.0 alike. Hash all integral numbers as int64.
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            value = long(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = long(value)
+
+        shards = cls.shards()
+        digest = zlib.crc32(bson.BSON.encode({'k': value})) & 0xffffffff
+        return shards[digest % len(shards)]
+
+    @classmethod
+    def target_shards(cls, filter_args):
+        '''
+        Returns the shards a query has to visit.
+        '''
+        if isinstance(filter_args, dict) and cls.__shardkey__ in filter_args:
+            value = filter_args[cls.__shardkey__]
+            if not isinstance(value, dict):
+                return [cls.shard_for(value)]
+
+            if value.keys() == ['$in']:
+                targets = []
+                for v in value['$in']:
+                    shard = cls.shard_for(v)
+                    if shard not in targets:
+                        targets.append(shard)
+                return targets
+
+        return cls.shards()
+
+    @classmethod
+    def _scatter(cls, databases, func, *args, **kwargs):
+        # Workers run on pool threads, carry the caller's deadline along.
+        expires = deadline.current()
+
+        def run(database):
+            with deadline.until(expires), cls.on_shard(database):
+                return func(*args, **kwargs)
+
+        if len(databases) == 1:
+            return [run(databases[0])]
+
+        return _thread_pool(cls.__scatter_threads__).map(run, databases)
+
+    @classmethod
+    def _shard_key_of(cls, document):
+        value = document.get(cls.__shardkey__)
+        if value is None:
+            raise ORMException(
+                "%s is required to store %s"
+                % (cls.__shardkey__, cls.__name__))
+        return value
+
+    @classmethod
+    def insert(cls, document, timeout=None):
+        if cls.routed() or not document:
+            return super(ShardedModel, cls).insert(document, timeout=timeout)
+
+        documents = document if isinstance(document, list) else [document]
+        for d in documents:
+            cls._shard_key_of(d)
+
+        # Validate everything before the first shard is written to.
+        groups = []
+        for d in cls.validate_insert(documents):
+            shard = cls.shard_for(cls._shard_key_of(d))
+            for database, group in groups:
+                if database == shard:
+                    group.append(d)
+                    break
+            else:
+                groups.append((shard, [d]))
+
+        with deadline.until(deadline.expiry(timeout)):
+            for database, group in groups:
+                with cls.on_shard(database):
+                    cls.insert_validated(group)
+
+        ids = [d['_id'] for d in documents]
+        return ids if isinstance(document, list) else ids[0]
+
+    @classmethod
+    def stored_shard_key(cls, _id, first=None):
+        '''
+        Returns the shard key a document is stored with, looking on
+        `first` before the other shards. None if it is not stored.
+        '''
+        expires = deadline.current()
+        shards = cls.shards()
+        if first is not None:
+            shards = [first] + [s for s in shards if s != first]
+
+        for database in shards:
+            call = cls.mongo_collection(database)
+            for document in deadline.find(call, expires, {'_id': _id},
+                                          fields=[cls.__shardkey__],
+                                          limit=1):
+                return _value(document, cls.__shardkey__)
+        return None
+
+    def save(self, validate=True, timeout=None):
+        if self.routed():
+            return super(ShardedModel, self).save(validate=validate,
+                                                  timeout=timeout)
+
+        key = self._shard_key_of(self)
+        shard = self.shard_for(key)
+        existing_id = self.get('_id')
+
+        with deadline.until(deadline.expiry(timeout)):
+            if existing_id and not isinstance(existing_id, DataType):
+                stored = self.stored_shard_key(existing_id, shard)
+                if stored is not None and stored != key:
+                    raise ORMException(
+                        "Shard key %s cannot be changed from %r to %r"
+                        % (self.__shardkey__, stored, key))
+
+            with self.on_shard(shard):
+                return super(ShardedModel, self).save(validate=validate)
+
+    @classmethod
+    def update(cls, filter_args, document, *args, **kwargs):
+        if cls.routed():
+            return super(ShardedModel, cls).update(
+                filter_args, document, *args, **kwargs)
+
+        for value in (document or {}).itervalues():
+            if isinstance(value, dict) and cls.__shardkey__ in value:
+                raise ORMException(
+                    "Shard key %s cannot be updated" % cls.__shardkey__)
+
+        # Update mutates its arguments, give each shard its own copy.
+        results = cls._scatter(
+            cls.target_shards(filter_args),
+            lambda: super(ShardedModel, cls).update(
+                dict(filter_args), dict((k, dict(v) if isinstance(v, dict)
+                                         else v)
+                                        for k, v in document.iteritems()),
+                *args, **kwargs))
+
+        results = [r for r in results if isinstance(r, dict)]
+        return {
+            'n': sum(r.get('n', 0) for r in results),
+            'ok': 1.0,
+            'err': None,
+            'updatedExisting': any(r.get('updatedExisting') for r in results)
+        }
+
+    @classmethod
+    def find_and_modify(cls, filter_args, *args, **kwargs):
+        if cls.routed():
+            return super(ShardedModel, cls).find_and_modify(
+                filter_args, *args, **kwargs)
+
+        targets = cls.target_shards(filter_args)
+        if len(targets) != 1:
+            raise ORMException(
+                "find_and_modify on %s requires %s in the query"
+                % (cls.__name__, cls.__shardkey__))
+
+        with cls.on_shard(targets[0]):
+            return super(ShardedModel, cls).find_and_modify(
+                filter_args, *args, **kwargs)
+
+    @classmethod
+    def _get(cls, filter_args=None, limit=None, skip=0, sort=-1,
+             sortkey='_id', **kwargs):
+        _super = super(ShardedModel, cls)._get
+        if cls.routed():
+            return _super(filter_args, limit=limit, skip=skip, sort=sort,
+                          sortkey=sortkey, **kwargs)
+
+        targets = cls.target_shards(_query(filter_args, kwargs))
+
+        if len(targets) == 1:
+            with cls.on_shard(targets[0]):
+                return _super(filter_args, limit=limit, skip=skip,
+                              sort=sort, sortkey=sortkey, **kwargs)
+
+        spec = []
+        if sort or sortkey:
+            if isinstance(sort, (list, tuple)):
+                spec = list(sort)
+            elif isinstance(sortkey, (list, tuple)):
+                spec = list(sortkey)
+            else:
+                spec = [(sortkey, sort)]
+
+        fields = kwargs.get('fields')
+        extra = []
+        if isinstance(fields, list):
+            # Sort keys have to come back to merge on them. _id always
+            # comes back, _get adds it to every projection.
+            extra = [k for k, _ in spec
+                     if k.split('.')[0] not in fields + ['_id']]
+
+        window = (skip or 0) + limit if limit else None
+        expires = deadline.expiry(kwargs.pop('timeout', None))
+        cursors = []
+
+        def fetch():
+            _kwargs = dict(kwargs)
+            if isinstance(fields, list):
+                _kwargs['fields'] = fields + extra
+            cursor = _super(filter_args, limit=window, skip=0, sort=sort,
+                            sortkey=sortkey, **_kwargs)
+            cursors.append(cursor)
+            return list(cursor)
+
+        documents = []
+        with deadline.until(expires):
+            for result in cls._scatter(targets, fetch):
+                documents.extend(result)
+
+        if spec:
+            _sort(documents, spec)
+        documents = documents[skip or 0:window]
+
+        for d in documents:
+            for k in extra:
+                d.pop(k.split('.')[0], None)
+
+        def counts():
+            return [c.count() for c in cursors]
+
+        return ScatterCursor(documents, counts)
+
+    @classmethod
+    def count(cls, *args, **kwargs):
+        if cls.routed():
+            return super(ShardedModel, cls).count(*args, **kwargs)
+
+        filter_args = args[0] if args else kwargs.get('filter_args')
+        return sum(cls._scatter(
+            cls.target_shards(_query(filter_args, kwargs)),
+            lambda: super(ShardedModel, cls).count(*args, **dict(kwargs))))
+
+    @classmethod
+    def get_one(cls, *args, **kwargs):
+        kwargs['limit'] = 1
+        documents = list(cls._get(*args, **kwargs))[:1]
+        return cls(partial_model=True, **documents[0]) if documents else None
+
+    @classmethod
+    def remove(cls, _id, *args, **kwargs):
+        if cls.routed():
+            return super(ShardedModel, cls).remove(_id, *args, **kwargs)
+
+        targets = cls.target_shards(_id) if isinstance(_id, dict) \
+            else cls.shards()
+        cls._scatter(targets, lambda: super(ShardedModel, cls).remove(
+            _id, *args, **kwargs))
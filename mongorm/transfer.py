@@ -0,0 +1,321 @@
+import os
+import re
+import sys
+import mmap
+import struct
+import argparse
+import warnings
+import importlib
+import multiprocessing
+
+import bson
+import pymongo
+from bson import json_util
+
+from .errors import ORMException
+
+FORMATS = ('bson', 'jsonl')
+MANIFEST = 'manifest.json'
+
+
+def _bound(lo, hi):
+    _range = {}
+    if lo is not None:
+        _range['$gte'] = lo
+    if hi is not None:
+        _range['$lt'] = hi
+    return {'_id': _range} if _range else {}
+
+
+def _shard_path(directory, index, fmt):
+    return os.path.join(directory, 'shard-%05d.%s' % (index, fmt))
+
+
+def _load_target(model):
+    '''
+    Names the collection a load writes to, so markers left by loading a
+    dump into one database do not skip shards loaded into another.
+    '''
+    database = model.valid_database()
+    if isinstance(database, pymongo.database.Database):
+        connection = database.connection
+        server = '%s:%s' % (connection.host, connection.port)
+    else:
+        # In-process stand-ins do not outlive the process.
+        server = '%s-%x' % (type(database).__name__, id(database))
+
+    target = '%s.%s.%s' % (server, database.name, model.__tablename__)
+    return re.sub(r'[^\w.-]', '_', target)
+
+
+def _load_marker(path, target):
+    return '%s.%s.loaded' % (path, target)
+
+
+def split_ranges(model, partitions):
+    '''
+    Splits the _id space of a model into at most `partitions` contiguous
+    ranges of roughly equal size. Returns a list of (lo, hi) tuples where
+    None stands for an open bound.
+    '''
+    call = model.mongo_collection(model.valid_database())
+    total = call.count()
+    if partitions <= 1 or total <= partitions:
+        return [(None, None)]
+
+    step = total // partitions
+    bounds = []
+    for i in xrange(1, partitions):
+        doc = next(iter(call.find({}, fields=['_id'], sort=[('_id', 1)],
+                                  skip=i * step, limit=1)), None)
+        if doc is not None and (not bounds or doc['_id'] != bounds[-1]):
+            bounds.append(doc['_id'])
+
+    edges = [None] + bounds + [None]
+    return zip(edges[:-1], edges[1:])
+
+
+def _dump_shard(args):
+    model, index, lo, hi, directory, fmt, batch_size = args
+    path = _shard_path(directory, index, fmt)
+    if os.path.exists(path):
+        return index, None
+
+    call = model.mongo_collection(model.valid_database())
+    cursor = call.find(_bound(lo, hi), sort=[('_id', 1)],
+                       as_class=dict, manipulate=False)
+    cursor.batch_size(batch_size)
+
+    count = 0
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as out:
+        for doc in cursor:
+            if fmt == 'bson':
+                out.write(bson.BSON.encode(doc))
+            else:
+                out.write(json_util.dumps(doc))
+                out.write('\n')
+            count += 1
+
+    os.rename(tmp, path)
+    return index, count
+
+
+def _iter_shard(path, fmt):
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if fmt == 'bson':
+                offset, size = 0, len(mm)
+                while offset < size:
+                    length = struct.unpack('<i', mm[offset:offset + 4])[0]
+                    yield bson.BSON(mm[offset:offset + length]).decode()
+                    offset += length
+            else:
+                for line in iter(mm.readline, ''):
+                    if line.strip():
+                        yield json_util.loads(line)
+        finally:
+            mm.close()
+
+
+def _insert_chunk(call, chunk):
+    '''
+    Inserts the documents of `chunk` whose _id is not stored yet, as a
+    resumed shard may already be partially loaded. Returns the number
+    inserted. Other unique index violations are raised.
+    '''
+    stored = set(d['_id'] for d in call.find(
+        {'_id': {'$in': [d['_id'] for d in chunk]}}, fields=['_id']))
+    chunk = [d for d in chunk if d['_id'] not in stored]
+    if not chunk:
+        return 0
+
+    try:
+        call.insert(chunk, manipulate=False)
+    except pymongo.errors.DuplicateKeyError, e:
+        raise ORMException("Could not load documents: %s" % e)
+    return len(chunk)
+
+
+def _load_shard(args):
+    model, path, marker, fmt, chunk_size, validate = args
+    call = model.mongo_collection(model.valid_database())
+    chunk = []
+    count = 0
+
+    for doc in _iter_shard(path, fmt):
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            if validate:
+                model.validate_many(chunk)
+            count += _insert_chunk(call, chunk)
+            chunk = []
+
+    if chunk:
+        if validate:
+            model.validate_many(chunk)
+        count += _insert_chunk(call, chunk)
+
+    open(marker, 'w').close()
+    return path, count
+
+
+def _run(worker, tasks, processes, progress):
+    total = len(tasks)
+    processed = 0
+    # Each process opens its own client, do not start more than needed.
+    processes = min(processes or multiprocessing.cpu_count(), total)
+
+    if processes == 1:
+        results = (worker(t) for t in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(worker, tasks)
+
+    try:
+        for done, (_, count) in enumerate(results, 1):
+            processed += count or 0
+            if callable(progress):
+                progress(done, total, processed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return processed
+
+
+def dump(model, directory, partitions=8, processes=None, fmt='bson',
+         batch_size=1000, progress=None):
+    '''
+    Exports every document of `model` into shard files in `directory`.
+
+    The _id space is split into `partitions` ranges which are scanned in
+    parallel. Shard files are written to a temporary name and renamed once
+    complete, so re-running a dump into the same directory resumes it.
+    '''
+    if fmt not in FORMATS:
+        raise ORMException("Format must be one of %s" % ', '.join(FORMATS))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json_util.loads(f.read())
+        if manifest['collection'] != model.__tablename__ or \
+           manifest['format'] != fmt:
+            raise ORMException(
+                "%s holds a dump of %s in %s format"
+                % (directory, manifest['collection'], manifest['format']))
+        ranges = manifest['ranges']
+    else:
+        ranges = split_ranges(model, partitions)
+        manifest = {
+            'collection': model.__tablename__,
+            'format': fmt,
+            'ranges': ranges
+        }
+        with open(manifest_path, 'w') as f:
+            f.write(json_util.dumps(manifest))
+
+    tasks = [(model, i, lo, hi, directory, fmt, batch_size)
+             for i, (lo, hi) in enumerate(ranges)]
+    return _run(_dump_shard, tasks, processes, progress)
+
+
+def load(model, directory, processes=None, chunk_size=500, validate=True,
+         progress=None, resume=True):
+    '''
+    Imports a dump written by `dump` into `model`'s collection.
+
+    Shard files are read through mmap, validated against the model and
+    inserted in chunks of `chunk_size`. Loaded shards are marked on disk
+    per target collection so an interrupted load can be resumed; with
+    resume=False the markers are cleared and every shard is loaded.
+    '''
+    manifest_path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise ORMException("No dump manifest found in %s" % directory)
+
+    with open(manifest_path) as f:
+        manifest = json_util.loads(f.read())
+
+    fmt = manifest['format']
+    target = _load_target(model)
+    tasks = []
+    skipped = []
+    for i in xrange(len(manifest['ranges'])):
+        path = _shard_path(directory, i, fmt)
+        if not os.path.exists(path):
+            raise ORMException("Dump in %s is incomplete. Missing %s"
+                               % (directory, path))
+
+        marker = _load_marker(path, target)
+        if os.path.exists(marker):
+            if resume:
+                skipped.append(path)
+                continue
+            os.remove(marker)
+
+        tasks.append((model, path, marker, fmt, chunk_size, validate))
+
+    if skipped:
+        warnings.warn(
+            "Skipping %d shard(s) of %s already loaded into %s. "
+            "Use resume=False to load them again."
+            % (len(skipped), directory, target))
+
+    if not tasks:
+        return 0
+
+    return _run(_load_shard, tasks, processes, progress)
+
+
+def _import_model(path):
+    module, _, name = path.partition(':')
+    if not name:
+        raise ORMException("Model must be given as package.module:Model")
+    return getattr(importlib.import_module(module), name)
+
+
+def _print_progress(done, total, processed):
+    sys.stderr.write("\r%d/%d shards, %d documents" % (done, total, processed))
+    if done == total:
+        sys.stderr.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parallel dump/load of mongorm model collections.")
+    parser.add_argument('action', choices=['dump', 'load'])
+    parser.add_argument('model', help="package.module:Model")
+    parser.add_argument('directory')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--format', choices=FORMATS, default='bson')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--no-validate', action='store_true')
+    parser.add_argument('--restart', action='store_true',
+                        help="load shards already marked as loaded again")
+    args = parser.parse_args(argv)
+
+    model = _import_model(args.model)
+    if args.action == 'dump':
+        dump(model, args.directory, partitions=args.partitions,
+             processes=args.processes, fmt=args.format,
+             progress=_print_progress)
+    else:
+        load(model, args.directory, processes=args.processes,
+             chunk_size=args.chunk_size, validate=not args.no_validate,
+             progress=_print_progress, resume=not args.restart)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+from bson.son import SON
+
+from .errors import ORMException
+from .meta import ViewDefinition, DbDictClass
+
+
+class BoundView(object):
+    '''
+    A MaterializedView bound to the model it was read from.
+    '''
+
+    def __init__(self, view, model):
+        self.view = view
+        self.model = model
+
+    def get(self, *key):
+        return self.view.get(self.model, *key)
+
+    def all(self):
+        return self.view.all(self.model)
+
+    def rebuild(self):
+        return self.view.rebuild(self.model)
+
+    def collection(self):
+        return self.view.collection(self.model)
+
+
+class MaterializedView(ViewDefinition):
+    '''
+    Incrementally maintained count, sum, min and max per group.
+
+        class Invoice(ModelBase):
+            __tablename__ = "invoice"
+
+            tenant = Unichar()
+            amount = Currency()
+
+            totals = MaterializedView('tenant', sum=['amount'],
+                                      max=['amount'])
+
+        Invoice.totals.get(u'acme')
+        {'_id': u'acme', 'count': 12, 'sum': {'amount': 310.5}, ...}
+
+    Groups are kept in the collection <tablename>_<view name> and updated
+    with deltas from insert, save, update, find_and_modify and remove.
+    Deleted documents are not counted. Removing the current min or max of
+    a group marks it stale and it is recomputed on the next read. Writes
+    that bypass the model, or concurrent writes racing between the before
+    and after reads of an update, can leave a view off; rebuild()
+    recomputes it.
+    '''
+
+    def __init__(self, group_by, count=True, sum=(), min=(), max=(),
+                 name=None):
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+
+        self.group_by = list(group_by)
+        self.count = count
+        self.sum = list(sum)
+        self.min = list(min)
+        self.max = list(max)
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return BoundView(self, owner)
+
+    @property
+    def fields(self):
+        return set(self.group_by + self.sum + self.min + self.max)
+
+    def check(self, model):
+        unknown = [f for f in self.fields if f not in model.fields]
+        if unknown:
+            raise ORMException(
+                "View %s on %s refers to unknown fields %s"
+                % (self.name, model.__tablename__, ', '.join(unknown)))
+
+    def collection(self, model, database=None):
+        database = database or model.valid_database()
+        return database['%s_%s' % (model.__tablename__, self.name)]
+
+    def key(self, document):
+        if len(self.group_by) == 1:
+            return document.get(self.group_by[0])
+        return SON((f, document.get(f)) for f in self.group_by)
+
+    def touches(self, fields):
+        return bool(self.fields.intersection(fields)) or 'deleted' in fields
+
+    def apply(self, model, database, before, after):
+        '''
+        Folds the change from `before` to `after` documents into the view.
+        '''
+        groups = {}
+
+        def group(document):
+            key = self.key(document)
+            return groups.setdefault(repr(key), {
+                'key': key, 'count': 0, 'sum': {}, 'min': {}, 'max': {},
+                'dropped_min': {}, 'dropped_max': {}})
+
+        for document in before:
+            if document.get('deleted'):
+                continue
+            g = group(document)
+            g['count'] -= 1
+            for f in self.sum:
+                g['sum'][f] = g['sum'].get(f, 0) - (document.get(f) or 0)
+            for f in self.min:
+                if document.get(f) is not None:
+                    g['dropped_min'][f] = min(
+                        g['dropped_min'].get(f, document[f]), document[f])
+            for f in self.max:
+                if document.get(f) is not None:
+                    g['dropped_max'][f] = max(
+                        g['dropped_max'].get(f, document[f]), document[f])
+
+        for document in after:
+            if document.get('deleted'):
+                continue
+            g = group(document)
+            g['count'] += 1
+            for f in self.sum:
+                g['sum'][f] = g['sum'].get(f, 0) + (document.get(f) or 0)
+            for f in self.min:
+                if document.get(f) is not None:
+                    g['min'][f] = min(g['min'].get(f, document[f]),
+                                      document[f])
+            for f in self.max:
+                if document.get(f) is not None:
+                    g['max'][f] = max(g['max'].get(f, document[f]),
+                                      document[f])
+
+        call = self.collection(model, database)
+        for g in groups.itervalues():
+            update = {}
+            inc = dict(('sum.%s' % f, v) for f, v in g['sum'].iteritems()
+                       if v)
+            if self.count and g['count']:
+                inc['count'] = g['count']
+            if inc:
+                update['$inc'] = inc
+            if g['min']:
+                update['$min'] = dict(('min.%s' % f, v)
+                                      for f, v in g['min'].iteritems())
+            if g['max']:
+                update['$max'] = dict(('max.%s' % f, v)
+                                      for f, v in g['max'].iteritems())
+            if update:
+                call.update({'_id': g['key']}, update, upsert=True)
+
+            stale = [{'min.%s' % f: {'$gte': v}}
+                     for f, v in g['dropped_min'].iteritems()] + \
+                    [{'max.%s' % f: {'$lte': v}}
+                     for f, v in g['dropped_max'].iteritems()]
+            if stale:
+                call.update({'_id': g['key'], '$or': stale},
+                            {'$set': {'stale': True}})
+
+    def _pipeline(self, match=None):
+        if len(self.group_by) == 1:
+            key = '$%s' % self.group_by[0]
+        else:
+            key = SON((f, '$%s' % f) for f in self.group_by)
+
+        group = {'_id': key, 'count': {'$sum': 1}}
+        for op in ('sum', 'min', 'max'):
+            for f in getattr(self, op):
+                group['%s_%s' % (op, f)] = {'$%s' % op: '$%s' % f}
+
+        query = {'deleted': False}
+        query.update(match or {})
+        return [{'$match': query}, {'$group': group}]
+
+    def _document(self, row):
+        document = {'_id': row['_id'], 'stale': False}
+        if self.count:
+            document['count'] = row['count']
+        for op in ('sum', 'min', 'max'):
+            values = dict((f, row.get('%s_%s' % (op, f)))
+                          for f in getattr(self, op))
+            if values:
+                document[op] = values
+        return document
+
+    def _aggregate(self, model, match=None):
+        result = model.aggregate(self._pipeline(match))
+        if isinstance(result, dict):
+            result = result.get('result', [])
+        return [self._document(row) for row in result]
+
+    def refresh(self, model, key):
+        match = dict(zip(self.group_by, [key] if len(self.group_by) == 1
+                         else key.values()))
+        call = self.collection(model)
+        rows = self._aggregate(model, match)
+        if rows:
+            call.save(rows[0])
+            return rows[0]
+
+        call.remove({'_id': key})
+        return None
+
+    def get(self, model, *key):
+        '''
+        Returns the group for `key`, one value per group_by field.
+        '''
+        self.check(model)
+        if len(key) != len(self.group_by):
+            raise ORMException("View %s is grouped by %s"
+                               % (self.name, ', '.join(self.group_by)))
+
+        key = self.key(dict(zip(self.group_by, key)))
+        document = self.collection(model).find_one({'_id': key})
+        if document and document.get('stale'):
+            document = self.refresh(model, key)
+        return DbDictClass(document) if document else None
+
+    def all(self, model):
+        self.check(model)
+        call = self.collection(model)
+        for document in call.find({'stale': True}):
+            self.refresh(model, document['_id'])
+        return [DbDictClass(d) for d in call.find()]
+
+    def rebuild(self, model):
+        '''
+        Recomputes the view from the model's collection.
+        '''
+        self.check(model)
+        rows = self._aggregate(model)
+        call = self.collection(model)
+        call.remove({})
+        if rows:
+            call.insert(rows)
+        return len(rows)
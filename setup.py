@@ -15,5 +15,6 @@ setup(
     url="http://simversity.github.io/mongorm",
     license="http://www.apache.org/licenses/LICENSE-2.0",
     description='''Python based ORM for MongoDB''',
+    test_suite="tests",
     zip_safe=False
 )
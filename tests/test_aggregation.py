@@ -0,0 +1,114 @@
+import unittest
+
+from mongorm.base import ModelBase
+from mongorm.memory import MemoryDatabase
+from mongorm.aggregation import Pipeline
+from mongorm.datatypes import Unichar, Integer, Boolean
+from mongorm.errors import ORMException
+
+DATABASE = []
+
+
+class Invoice(ModelBase):
+    __tablename__ = "invoice"
+
+    tenant = Unichar()
+    amount = Integer()
+    paid = Boolean()
+
+    @classmethod
+    def using(cls):
+        return DATABASE[0]
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        DATABASE[:] = [MemoryDatabase()]
+        Invoice.insert([{'tenant': [u'a', u'b', u'c'][i % 3],
+                         'amount': i, 'paid': i % 2 == 0}
+                        for i in xrange(20)])
+
+    def run_stages(self, stages):
+        return Invoice.aggregate(stages)['result']
+
+    def assertReordered(self, pipeline, expected):
+        optimized = pipeline.optimized()
+        self.assertEqual([stage.keys()[0] for stage in optimized], expected)
+        self.assertEqual(self.run_stages(optimized),
+                         self.run_stages(pipeline.stages))
+
+    def test_match_moves_ahead_of_sort(self):
+        pipeline = Invoice.pipeline().sort([('amount', -1)]) \
+            .match({'paid': True})
+        self.assertReordered(pipeline, ['$match', '$sort'])
+
+    def test_match_moves_ahead_of_passing_project(self):
+        pipeline = Invoice.pipeline() \
+            .project({'tenant': 1, 'amount': 1}) \
+            .match({'amount': {'$gt': 12}})
+        self.assertReordered(pipeline, ['$match', '$project'])
+
+    def test_match_stays_after_computed_field(self):
+        pipeline = Invoice.pipeline().project({'total': '$amount'}) \
+            .match({'total': {'$gt': 12}})
+        self.assertReordered(pipeline, ['$project', '$match'])
+
+    def test_project_moves_ahead_of_sort_it_keeps(self):
+        pipeline = Invoice.pipeline().sort([('amount', 1)]) \
+            .project({'amount': 1, 'tenant': 1})
+        self.assertReordered(pipeline, ['$project', '$sort'])
+
+        pipeline = Invoice.pipeline().sort([('amount', 1)]) \
+            .project({'tenant': 1})
+        self.assertReordered(pipeline, ['$sort', '$project'])
+
+    def test_adjacent_matches_merge(self):
+        pipeline = Invoice.pipeline().match({'paid': True}) \
+            .sort([('amount', -1)]).match({'tenant': u'a'})
+        self.assertReordered(pipeline, ['$match', '$sort'])
+        self.assertEqual([d['amount'] for d in
+                          self.run_stages(pipeline.optimized())],
+                         [18, 12, 6, 0])
+
+    def test_match_stays_after_group(self):
+        pipeline = Invoice.pipeline() \
+            .group({'_id': '$tenant', 'total': {'$sum': '$amount'}}) \
+            .match({'total': {'$gt': 60}})
+        self.assertReordered(pipeline, ['$group', '$match'])
+
+    def test_passes_through_dotted_paths(self):
+        swap = Pipeline._can_swap
+        self.assertTrue(swap({'$project': {'info.secret': 0}},
+                             {'$match': {'info.x': 1}}))
+        self.assertFalse(swap({'$project': {'info.secret': 0}},
+                              {'$match': {'info': {'x': 1}}}))
+        self.assertTrue(swap({'$project': {'info': 1}},
+                             {'$match': {'info.x': 1}}))
+        self.assertFalse(swap({'$project': {'info.x': 1}},
+                              {'$match': {'info': {'x': 1}}}))
+
+    def test_field_references(self):
+        with self.assertRaises(ORMException):
+            Invoice.pipeline().sort([('missing', 1)])
+
+        pipeline = Invoice.pipeline().sort([('created_on', -1)]) \
+            .project({'tenant': 1, 'modified_on': 1})
+        self.assertEqual(len(self.run_stages(pipeline.optimized())), 20)
+
+        with self.assertRaises(ORMException):
+            Invoice.pipeline().group({'_id': '$tenant'}) \
+                .sort([('amount', 1)])
+
+    def test_cursor_yields_models_while_typed(self):
+        results = list(Invoice.pipeline().match({'tenant': u'b'}))
+        self.assertTrue(all(isinstance(r, Invoice) for r in results))
+        self.assertEqual(len(results), 7)
+
+        results = list(Invoice.pipeline().group(
+            {'_id': '$tenant', 'n': {'$sum': 1}}))
+        self.assertFalse(any(isinstance(r, Invoice) for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+
+from mongorm.memory import MemoryDatabase
+from mongorm.sharding import ShardedModel
+from mongorm.datatypes import Unichar, Integer
+from mongorm.errors import ORMException
+
+SHARDS = []
+
+
+class Event(ShardedModel):
+    __tablename__ = "event"
+    __shardkey__ = "tenant"
+
+    tenant = Unichar(nullable=False)
+    n = Integer()
+
+    @classmethod
+    def shards(cls):
+        return SHARDS
+
+
+class Visit(ShardedModel):
+    __tablename__ = "visit"
+    __shardkey__ = "tenant"
+
+    tenant = Unichar(nullable=False)
+
+    @classmethod
+    def shards(cls):
+        return SHARDS
+
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        SHARDS[:] = [MemoryDatabase('shard%d' % i) for i in xrange(3)]
+        self.tenants = [u'tenant%d' % i for i in xrange(6)]
+        Event.insert([{'tenant': tenant, 'n': i * 6 + j}
+                      for j, tenant in enumerate(self.tenants)
+                      for i in xrange(5)])
+
+    def stored(self):
+        return [len(shard.event.documents) for shard in SHARDS]
+
+    def test_insert_spreads_across_shards(self):
+        self.assertEqual(sum(self.stored()), 30)
+        self.assertTrue(len([c for c in self.stored() if c]) > 1)
+
+        for tenant in self.tenants:
+            shard = Event.shard_for(tenant)
+            for database in SHARDS:
+                count = len([d for d in database.event.documents.values()
+                             if d['tenant'] == tenant])
+                self.assertEqual(count, 5 if database is shard else 0)
+
+    def test_insert_validates_before_writing(self):
+        before = self.stored()
+        with self.assertRaises(ORMException):
+            Event.insert([{'tenant': u'a', 'n': 1},
+                          {'tenant': u'b', 'n': 'bad'}])
+        self.assertEqual(self.stored(), before)
+
+    def test_shard_for_normalizes_numbers(self):
+        self.assertTrue(Event.shard_for(5) is Event.shard_for(5L))
+        self.assertTrue(Event.shard_for(5) is Event.shard_for(5.0))
+
+    def test_scatter_sort_skip_limit(self):
+        values = [e['n'] for e in Event.get_many(sort=1, sortkey='n')]
+        self.assertEqual(values, range(30))
+
+        values = [e['n'] for e in Event.get_many(sort=-1, sortkey='n',
+                                                 skip=4, limit=7)]
+        self.assertEqual(values, range(25, 18, -1))
+
+    def test_scatter_projection_keeps_id(self):
+        documents = list(Event.get_many(fields=['n'], sort=1, sortkey='n',
+                                        limit=3))
+        self.assertEqual([d['n'] for d in documents], [0, 1, 2])
+        for document in documents:
+            self.assertEqual(sorted(document.keys()), ['_id', 'n'])
+
+        records = list(Event.get_records(fields=['n']))
+        self.assertEqual(len(records), 30)
+        self.assertTrue(all(r._id is not None for r in records))
+
+    def test_count(self):
+        self.assertEqual(Event.count(), 30)
+        self.assertEqual(Event.count({'n': {'$lt': 10}}), 10)
+        self.assertEqual(Event.count({'tenant': self.tenants[0]}), 5)
+        self.assertEqual(Event.get_many(limit=4).count(), 30)
+
+    def test_routing(self):
+        tenant = self.tenants[1]
+        shard = Event.shard_for(tenant)
+        self.assertEqual(Event.target_shards({'tenant': tenant}), [shard])
+        self.assertEqual(Event.target_shards({'n': 1}), SHARDS)
+
+        targets = Event.target_shards({'tenant': {'$in': self.tenants}})
+        self.assertEqual(sorted(targets), sorted(set(
+            Event.shard_for(t) for t in self.tenants)))
+
+        self.assertEqual(Event.get_one({'tenant': tenant, 'n': 1})['n'], 1)
+        with Event.on_shard(shard):
+            self.assertEqual(Event.count({'tenant': tenant}), 5)
+
+        with self.assertRaises(ORMException):
+            Event.valid_database()
+
+    def test_routing_is_per_model(self):
+        shard = Event.shard_for(self.tenants[0])
+        tenant = [t for t in self.tenants
+                  if Visit.shard_for(t) is not shard][0]
+        Visit.insert([{'tenant': t} for t in self.tenants])
+
+        with Event.on_shard(shard):
+            self.assertTrue(Event.routed())
+            self.assertFalse(Visit.routed())
+            self.assertEqual(Visit.count(), 6)
+            Visit.insert({'tenant': tenant})
+
+        self.assertFalse(Event.routed())
+        documents = Visit.shard_for(tenant).visit.documents.values()
+        self.assertEqual(len([d for d in documents
+                              if d['tenant'] == tenant]), 2)
+
+    def test_save_rejects_shard_key_change(self):
+        event = Event.get_one({'tenant': self.tenants[0], 'n': 0})
+        event.n = 50
+        event.save()
+        self.assertEqual(Event.count({'n': 50}), 1)
+
+        moved = [t for t in self.tenants
+                 if Event.shard_for(t) is not Event.shard_for(event.tenant)]
+        for tenant in (self.tenants[1], moved[0]):
+            event.tenant = tenant
+            with self.assertRaises(ORMException):
+                event.save()
+        self.assertEqual(Event.count(), 30)
+        self.assertEqual(Event.count({'tenant': self.tenants[0]}), 5)
+
+    def test_find_and_modify_requires_shard_key(self):
+        with self.assertRaises(ORMException):
+            Event.find_and_modify({'n': 1}, {'$set': {'n': 100}})
+
+        tenant = self.tenants[0]
+        Event.find_and_modify({'tenant': tenant, 'n': 0},
+                              {'$set': {'n': 100}})
+        self.assertEqual(Event.count({'n': 100}), 1)
+
+    def test_update(self):
+        result = Event.update({'n': {'$gte': 20}}, {'$set': {'n': -1}})
+        self.assertEqual(result['n'], 10)
+        self.assertTrue(result['updatedExisting'])
+        self.assertEqual(Event.count({'n': -1}), 10)
+
+        result = Event.update({'tenant': self.tenants[2]},
+                              {'$set': {'n': -2}})
+        self.assertEqual(result['n'], 5)
+
+        with self.assertRaises(ORMException):
+            Event.update({'n': 1}, {'$set': {'tenant': u'other'}})
+
+    def test_remove(self):
+        Event.remove({'tenant': self.tenants[3]})
+        self.assertEqual(Event.count({'deleted': False}), 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
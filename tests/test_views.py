@@ -0,0 +1,94 @@
+import unittest
+
+from mongorm.base import ModelBase
+from mongorm.memory import MemoryDatabase
+from mongorm.views import MaterializedView
+from mongorm.datatypes import Unichar, Integer
+
+DATABASE = []
+
+
+class Invoice(ModelBase):
+    __tablename__ = "invoice"
+
+    tenant = Unichar()
+    amount = Integer()
+    views = Integer()
+
+    totals = MaterializedView('tenant', sum=['amount'], min=['amount'],
+                              max=['amount'])
+
+    @classmethod
+    def using(cls):
+        return DATABASE[0]
+
+
+class MaterializedViewTest(unittest.TestCase):
+
+    def setUp(self):
+        DATABASE[:] = [MemoryDatabase()]
+        Invoice.insert([{'tenant': u'a', 'amount': 5, 'views': 0},
+                        {'tenant': u'a', 'amount': 10, 'views': 0},
+                        {'tenant': u'b', 'amount': 7, 'views': 0}])
+
+    def find(self, amount):
+        return Invoice.get_one({'amount': amount})
+
+    def assertGroup(self, tenant, count, total, low, high):
+        group = Invoice.totals.get(tenant)
+        self.assertEqual((group['count'], group['sum']['amount'],
+                          group['min']['amount'], group['max']['amount']),
+                         (count, total, low, high))
+
+    def test_field_named_views_is_kept(self):
+        self.assertIn('views', Invoice.fields)
+        self.assertEqual(Invoice.__views__.keys(), ['totals'])
+
+    def test_insert(self):
+        self.assertGroup(u'a', 2, 15, 5, 10)
+        self.assertGroup(u'b', 1, 7, 7, 7)
+
+    def test_update(self):
+        Invoice.update({'amount': 5}, {'$set': {'amount': 20}})
+        self.assertGroup(u'a', 2, 30, 10, 20)
+
+    def test_update_moves_group(self):
+        Invoice.update({'amount': 7}, {'$set': {'tenant': u'a'}})
+        self.assertGroup(u'a', 3, 22, 5, 10)
+        self.assertIsNone(Invoice.totals.get(u'b'))
+
+    def test_save(self):
+        invoice = self.find(10)
+        invoice.amount = 1
+        invoice.save()
+        self.assertGroup(u'a', 2, 6, 1, 5)
+
+    def test_find_and_modify(self):
+        Invoice.find_and_modify({'tenant': u'a'},
+                                {'$set': {'amount': 2}},
+                                sort=1, sortkey='amount')
+        self.assertGroup(u'a', 2, 12, 2, 10)
+
+    def test_find_and_modify_without_view_fields(self):
+        Invoice.find_and_modify({'tenant': u'a'}, {'$set': {'views': 3}})
+        self.assertGroup(u'a', 2, 15, 5, 10)
+
+    def test_remove(self):
+        Invoice.remove(self.find(7)._id)
+        self.assertIsNone(Invoice.totals.get(u'b'))
+
+    def test_remove_marks_min_and_max_stale(self):
+        Invoice.insert({'tenant': u'a', 'amount': 8, 'views': 0})
+        Invoice.remove([self.find(5)._id, self.find(10)._id])
+        self.assertGroup(u'a', 1, 8, 8, 8)
+
+    def test_rebuild(self):
+        call = Invoice.mongo_collection(DATABASE[0])
+        call.update({'amount': 7}, {'$set': {'amount': 70}})
+        self.assertGroup(u'b', 1, 7, 7, 7)
+        self.assertEqual(Invoice.totals.rebuild(), 2)
+        self.assertGroup(u'b', 1, 70, 70, 70)
+
+
+if __name__ == '__main__':
+    unittest.main()